@@ -0,0 +1,198 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from json_runner import Engine
+from json_runner.string_parsing import parse2, parse_interpolated, tokenize
+
+sys.setrecursionlimit(100000)
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.removeprefix("bench_")] = func
+    return func
+
+
+LINES = [
+    "set x $a + 2 * $b - ($c / 4) if $flag else [list 1 2 3]",
+    "say Hello, ($name)! You have ($count) new (\"message\" if $count == 1 else \"messages\").",
+    "foo bar baz $qux.0 is in [list 1 2 3] and not $done",
+    "set total $total + $item.price * $item.qty",
+]
+
+
+def _engine(*program):
+    e = Engine()
+    e.eval(list(program))
+    return e
+
+
+@benchmark
+def bench_tokenize():
+    atoms = list(Engine().ops)
+    return lambda: [list(tokenize(line, atoms)) for line in LINES]
+
+
+@benchmark
+def bench_parse2():
+    atoms = list(Engine().ops)
+    return lambda: [parse2(line, atoms, "()") for line in LINES]
+
+
+@benchmark
+def bench_parse_interpolated():
+    atoms = list(Engine().ops)
+    return lambda: [parse_interpolated(line, atoms) for line in LINES]
+
+
+@benchmark
+def bench_expr():
+    e = _engine("set a 3", "set b 4")
+    tree = e.parse("1 + 2 * $a - $b / 2 == 5 and 3 < 4 or not 0", "expr")
+    return lambda: e.expr(tree)
+
+
+@benchmark
+def bench_long_set():
+    e = Engine()
+    line = "set " + " ".join(f"v{i} {i} + 1" for i in range(100))
+    return lambda: e.eval(line)
+
+
+@benchmark
+def bench_while():
+    e = Engine()
+    program = ["set i 0", {"while": "$i < 200", "do": "set i $i + 1"}]
+    return lambda: e.eval(program)
+
+
+@benchmark
+def bench_foreach():
+    e = Engine()
+    program = ["set t 0", {"foreach": "i", "in": "0 to 200", "do": [
+        {"if": "$i % 2 == 0", "then": "next", "else": None},
+        "set t $t + $i"]}]
+    return lambda: e.eval(program)
+
+
+@benchmark
+def bench_fib():
+    e = _engine({"function": "fib", "params": ["n"], "do": [
+        {"if": "$n < 2", "then": "return $n", "else": "return [fib $n - 1] + [fib $n - 2]"}]})
+    return lambda: e.eval("fib 12")
+
+
+@benchmark
+def bench_template():
+    e = _engine("set name world", "set n 5")
+    program = {"template": {"greeting": {"insert": "quote hello ($name)"},
+                            "static": {"a": [1, 2, 3], "b": {"c": "d", "e": [{"f": "g"}] * 5}},
+                            "items": [{"n": {"insert": "set n"}}] * 10}}
+    return lambda: e.eval(program)
+
+
+@benchmark
+def bench_interpolate():
+    e = _engine("set name world", "set count 3")
+    program = ["say Hello, ($name)! You have ($count) new (\"message\" if $count == 1 else \"messages\")."] * 20
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            e.eval(program)
+    return run
+
+
+def measure(setup, min_time):
+    func = setup()
+    func()
+    count, start = 0, time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < min_time:
+        func()
+        count += 1
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"ops_per_sec": count / elapsed, "peak_alloc_bytes": peak}
+
+
+STARTUP = """
+import time
+start = time.perf_counter()
+import json_runner
+imported = time.perf_counter()
+json_runner.Engine().eval(["set x 1", {"if": "$x == 1", "then": "quote ($x)", "else": None}])
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def measure_startup(runs):
+    # a fresh interpreter each time, since after the first run everything
+    # is already imported and cached
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    times = [list(map(float, subprocess.run([sys.executable, "-c", STARTUP], env=env, check=True,
+                                            capture_output=True, text=True).stdout.split()))
+             for _ in range(runs)]
+    return {"import_ms": statistics.median(t[0] for t in times) * 1000,
+            "first_eval_ms": statistics.median(t[1] for t in times) * 1000}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="json_runner benchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all)")
+    parser.add_argument("-t", "--time", type=float, default=1.0, help="seconds per benchmark")
+    parser.add_argument("-o", "--output", help="write results as JSON to this file")
+    parser.add_argument("-c", "--compare", help="compare against a JSON results file")
+    parser.add_argument("-s", "--startup", type=int, default=0, metavar="RUNS",
+                        help="time importing json_runner and the first eval in RUNS new interpreters "
+                             "(instead of the other benchmarks, unless they are named)")
+    args = parser.parse_args(argv)
+    names = args.names or ([] if args.startup else list(BENCHMARKS))
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    results = {}
+    for name in names:
+        results[name] = r = measure(BENCHMARKS[name], args.time)
+        line = f"{name:24} {r['ops_per_sec']:12.1f} ops/s {r['peak_alloc_bytes'] / 1024:10.1f} KiB peak"
+        if name in baseline:
+            line += f"  x{r['ops_per_sec'] / baseline[name]['ops_per_sec']:.2f}"
+        print(line)
+    startup = None
+    if args.startup:
+        startup = measure_startup(args.startup)
+        print(f"{'import':24} {startup['import_ms']:12.1f} ms")
+        print(f"{'first eval':24} {startup['first_eval_ms']:12.1f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"revision": git_revision(),
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "time": time.time(),
+                       "results": results,
+                       "startup": startup}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
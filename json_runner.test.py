@@ -1,5 +1,20 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
 import yaml
-from json_runner import Engine
+from json_runner import Abort, Engine, LimitExceeded
+from json_runner.aio import AsyncEngine
+from json_runner.diskcache import DiskCache
+from json_runner.optimizer import Optimizer
+from json_runner.streaming import iter_statements
+from json_runner.string_parsing import IncrementalParser, get_tokenizer, parse2, parse_interpolated
+from json_runner.vm import VMEngine
 import sys
 
 
@@ -14,8 +29,7 @@ while step > 1:
     step //= 2
 print("max recursion limit:", hex(limit))
 
-x = Engine()
-x.eval(yaml.full_load("""
+smoke = yaml.full_load("""
 - set x 1
 - if: $x == 1
   then: say foo bar
@@ -109,4 +123,584 @@ x.eval(yaml.full_load("""
 - say (#[list 1 2 3])
 - say I'm a tomato!
 - say (sandbox world door)
-"""))
+""")
+x = Engine()
+x.eval(smoke)
+
+# the sequence functions only do what is asked of them, each time it is
+e = Engine()
+e.eval([{"function": "double", "params": ["x"], "do": ["set calls $calls + 1", "return $x * 2"]},
+        {"function": "odd", "params": ["x"], "do": "return $x % 2"},
+        "set calls 0",
+        "set m [map $double 0 to 100000000]"])
+assert e.eval("set calls") == 0
+assert e.eval([{"foreach": "x", "in": "[take 3 $m]", "do": "set last $x"}, "list $last $calls"]) == [4, 3]
+for line, value, calls in (("set v $m.4", 8, 5),
+                           ("set v [list @[take 4 $m]]", [0, 2, 4, 6], 4),
+                           ("set v #[take 4 $m]", 4, 4),
+                           ("set v [quote ([take 2 $m])]", "[0, 2]", 2),
+                           ("set v [take 1 $m] and 1", 1, 1)):
+    e.eval("set calls 0")
+    assert e.eval(line) == value, (line, e.eval(line))
+    assert e.eval("set calls") == calls, line
+# and can be gone through again, which runs the functions again
+e.eval(["set calls 0", "set t [take 3 $m]"])
+assert e.eval("list @$t @$t") == [0, 2, 4, 0, 2, 4]
+assert e.eval("set calls") == 6
+assert e.eval("list @[filter $odd [list 1 2 3 4 5]]") == [1, 3, 5]
+assert e.eval("list @[zip (1 to 4) [list a b c d e]]") == [(1, "a"), (2, "b"), (3, "c")]
+assert e.eval("list ([filter $odd [list 2 4]] or empty)") == ["empty"]
+
+# parallel_foreach keeps the order of the items, whatever order they finish in
+class Napping(Engine):
+    def func_nap(self, line):
+        seconds, = self.expr(line)
+        time.sleep(seconds)
+
+
+parallel = {"parallel_foreach": "x", "in": "0 to 8", "workers": 4, "do": [
+    "nap (8 - $x) / 200",
+    {"if": "$x == 1", "then": "next", "else": None},
+    {"if": "$x == 6", "then": "done", "else": None},
+    "set seen $x",
+    "set r $x * $x"]}
+for compiled in (False, True):
+    e = Napping()
+    e.eval("set seen none")
+    code = e.compile(parallel) if compiled else parallel
+    assert e.eval(code) == [0, 4, 9, 16, 25], compiled
+    # each iteration has its own copy of the variables
+    assert e.eval("set seen") == "none"
+# the error of the first failing iteration in order is the one raised
+e = Napping()
+try:
+    e.eval({"parallel_foreach": "x", "in": "0 to 8", "do": [
+        "nap (8 - $x) / 200",
+        {"if": "$x == 2 or $x == 5", "then": "abort [quote failed ($x)]", "else": None}]})
+except Abort as exc:
+    assert exc.args[0] == "failed 2", exc
+else:
+    raise AssertionError("parallel_foreach swallowed an error")
+assert Engine().eval({"parallel_foreach": "x", "in": "0 to 5", "pool": "processes", "workers": 2,
+                      "do": "set r $x + 1"}) == [1, 2, 3, 4, 5]
+
+# forks have variables of their own but share the engine's caches, and the
+# functions they are given still see what they closed over
+e = Engine()
+e.output = [].append
+e.eval([{"function": "f", "params": [], "do": "return $x"}, "set x 1"])
+fork = e.fork(e.snapshot_scope())
+assert fork.eval(["set x 2", "f"]) == 1
+assert fork.eval("set x") == 2 and e.eval("set x") == 1
+fork.eval("set y 3")
+try:
+    e.eval("set z $y")
+except UnboundLocalError:
+    pass
+else:
+    raise AssertionError("a fork's variable leaked into its parent")
+assert e.fork().scope_stack == [{}]
+assert fork.parse_cache is e.parse_cache and fork.template_cache is e.template_cache
+assert fork.output is e.output
+compiled = e.compile(["set n 0", {"foreach": "i", "in": "0 to $count", "do": "set n $n + [f] + $i"}, "set n"])
+results = []
+
+
+def run(engine):
+    results.append(engine.eval(compiled))
+
+
+threads = [threading.Thread(target=run, args=(e.fork({"count": count, "f": e.eval("set f")}),))
+           for count in range(1, 9)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+assert sorted(results) == [count + count * (count - 1) // 2 for count in range(1, 9)], results
+
+# expr_batch gives what expr gives row by row, errors included
+def rows(engine, source, columns):
+    out = []
+    for values in zip(*columns.values()):
+        row = engine.fork(engine.snapshot_scope() | dict(zip(columns, values)))
+        try:
+            out.append(row.expr(source)[0])
+        except Exception as exc:
+            return type(exc)
+    return out
+
+
+def batch(engine, source, columns):
+    try:
+        return engine.expr_batch(source, columns)
+    except Exception as exc:
+        return type(exc)
+
+
+e = Engine()
+e.eval([{"function": "twice", "params": ["x"], "do": "return $x * 2"}, "set k 3"])
+rng = random.Random(17)
+columns = {"a": [rng.randint(-5, 5) for _ in range(50)],
+           "b": [rng.randint(1, 5) for _ in range(50)],
+           "s": [rng.choice(["x", "yy", ""]) for _ in range(50)]}
+for source in ("$a + $b * $k", "$a / $b - 1", "$a % $b == 0", "$a < $b and $b <= 3", "$a or $b",
+               "not $a", "$s + \"?\"", "$s == \"yy\" || $a > 0", "#$s + $a", "[twice $a] + $b",
+               "$a if $a > 0 else $b", "$k * 2", "$a / ($b - $b)", "$s * $b", "$a + $s"):
+    for cols in (columns, {name: values[:1] for name, values in columns.items()},
+                 {name: [] for name in columns}):
+        assert batch(e, source, cols) == rows(e, source, cols), source
+assert e.expr_batch("$k + 1", {}) == []
+try:
+    e.expr_batch("$a + $b", {"a": [1, 2], "b": [1]})
+except ValueError:
+    pass
+else:
+    raise AssertionError("columns of different lengths were accepted")
+
+# loops that call nothing still run out of steps and time
+for engine_class in (Engine, VMEngine):
+    for program in ({"foreach": "i", "in": "0 to 30000000", "do": None},
+                    {"while": "1", "do": "next"}):
+        for limits in ({"steps": 1000}, {"seconds": 0.5}):
+            e = engine_class()
+            for code in (program, e.compile(program)):
+                try:
+                    with e.limit(**limits):
+                        e.eval(code)
+                except LimitExceeded as exc:
+                    assert exc.limit == next(iter(limits)), exc
+                    assert exc.usage["seconds"] < 5, exc.usage
+                else:
+                    raise AssertionError(f"{program} ran past {limits}")
+
+# each limit stops a program that goes over it, on both engines
+limited = [
+    {"function": "down", "params": ["n"], "do": [
+        {"if": "$n > 0", "then": "down $n - 1", "else": None}]},
+    {"function": "grow", "params": ["s", "n"], "do": [
+        {"foreach": "i", "in": "0 to $n", "do": "set s [quote ($s)xxxxxxxxxxxxxxxxxxxx]"},
+        "return $s"]},
+]
+for engine_class in (Engine, VMEngine):
+    for program, limits, name in (("down 50", {"depth": 20}, "depth"),
+                                  ("set x 1 + 2 + 3 + 4 + 5", {"ops": 3}, "ops"),
+                                  ("grow \"\" 1000", {"memory": 100000}, "memory")):
+        e = engine_class()
+        e.eval(limited)
+        try:
+            with e.limit(**limits):
+                e.eval(program)
+        except LimitExceeded as exc:
+            assert exc.limit == name, exc
+            assert exc.usage[name] > limits[name], exc.usage
+        else:
+            raise AssertionError(f"{program} ran past {limits}")
+        # once the limits are off the engine runs it to the end, and at full speed
+        assert e.limits is None and "expr" not in e.__dict__
+        e.eval(program)
+        with e.limit(depth=60, ops=100000, memory=10 ** 9) as limits:
+            e.eval(program)
+        assert limits.usage()["steps"] > 0
+
+# profiling inside limits (or the other way round) leaves the outer one
+# in place when the inner one comes off
+for engine_class in (Engine, VMEngine):
+    e = engine_class()
+    plain = dict(e.__dict__)
+    with e.limit(ops=10) as limits:
+        with e.profile() as profiler:
+            e.eval("set x 1 + 1")
+        assert profiler.stats["op +"][0] == 1
+        try:
+            e.eval("set x 1 + 2 + 3 + 4 + 5 + 6 + 7 + 8 + 9 + 10 + 11 + 12")
+        except LimitExceeded as exc:
+            assert exc.limit == "ops", exc
+        else:
+            raise AssertionError("ops weren't counted once the profiler was detached")
+    with e.profile() as profiler:
+        with e.limit(steps=100):
+            e.eval("set x 1 + 1")
+        e.eval("set x 1 + 1")
+    assert profiler.stats["op +"][0] == 2
+    assert e.__dict__.keys() == plain.keys()
+    # taking them off in the wrong order would leave one wrapping the other
+    profiler = e.profile()
+    limits = e.limit(steps=100)
+    try:
+        profiler.detach()
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("profiler came off from under the limits")
+    limits.detach()
+    profiler.detach()
+    assert e.__dict__.keys() == plain.keys()
+
+# statements split across chunks at every possible point, numbers included
+statements = [12.5, -3e-2, 1e10, 0, "say hi", {"if": "1", "then": [1.25, "x"], "else": None},
+              True, None, "caf\u00e9 \u2603", [[], {}], 100]
+text = json.dumps(statements)
+lines = "\n".join(map(json.dumps, statements)) + "\n"
+for chunk_size in (1, 2, 3, 5, 7, 64, 65536):
+    assert list(iter_statements(io.StringIO(text), chunk_size=chunk_size)) == statements
+    assert list(iter_statements(io.BytesIO(text.encode()), chunk_size=chunk_size)) == statements
+    assert list(iter_statements(io.StringIO(lines), chunk_size=chunk_size)) == statements
+assert list(iter_statements(io.StringIO("[12.5]"), chunk_size=1)) == [12.5]
+padded = "[" + " " * (65536 - 4) + "12.5]"
+assert list(iter_statements(io.StringIO(padded))) == [12.5]
+
+# a host's override of a builtin or block wins over the async twin
+class LoggingAsyncEngine(AsyncEngine):
+    def func_set(self, line):
+        self.log.append(line)
+        return super().func_set(line)
+
+    def block_if_then_else(self, block):
+        self.log.append("if")
+        return super().block_if_then_else(block)
+
+
+e = LoggingAsyncEngine()
+e.log = []
+assert asyncio.run(e.aeval(["set a 2", {"if": "$a == 2", "then": "quote yes", "else": None}])) == "yes"
+assert e.log == ["a 2", "if"], e.log
+
+# constant folding
+optimizer = Optimizer(Engine())
+
+
+def fold(source):
+    return optimizer.expression(optimizer.engine.parse(source, "expr")).elements
+
+
+assert fold("60 * 60 * 24") == (86400,)
+assert fold("1 to 100") == (range(1, 100),)
+assert fold("foo if yes else bar") == ("foo",)
+assert fold("$x + 60 * 60") == ("$", "x", "+", 3600)
+assert fold("(1 + 2) * $x") == (3, "*", "$", "x")
+# an if without an else gives a new list each time, so it isn't folded
+assert fold("foo if 1") == ("foo", "if", 1)
+e = Engine()
+e.eval(e.optimize([{"function": "f", "params": [], "do": "return foo if 1"},
+                   "setsub [f] 0 changed"]))
+assert e.eval("f") == ["foo"]
+# $x * 2 happens before the + so 2 + 3 can't be added up first
+assert fold("$x * 2 + 3") == ("$", "x", "*", 2, "+", 3)
+assert fold("1 / 0") == (1, "/", 0)
+
+# folding gives the same answers as not folding
+e = Engine()
+e.eval(["set a 3", "set b 0", "set s hello"])
+frozen = Optimizer(e, {"a": 3, "s": "hello"})
+rng = random.Random(0)
+pieces = ["1", "2", "0", "2.5", "$a", "$b", "$s", "foo", '"x"', "[list 1 2]",
+          "+", "-", "*", "/", "%", "^", "==", "<", ">=", "and", "or", "not", "to",
+          "#", "if", "else", "in", "contains", "@", "."]
+
+
+def expression(depth=0):
+    return " ".join("(" + expression(depth + 1) + ")" if depth < 2 and rng.random() < 0.1
+                    else rng.choice(pieces) for _ in range(rng.randint(1, 6)))
+
+
+def outcome(tree):
+    try:
+        return repr(e.expr(tree))
+    except Exception as exc:
+        return type(exc)
+
+
+for _ in range(3000):
+    tree = e.parse(expression(), "expr")
+    want = outcome(tree)
+    if "nan" not in str(want):
+        assert outcome(optimizer.expression(tree)) == want, tree
+        assert outcome(frozen.expression(tree)) == want, tree
+
+# frozen variables, shadowed by function parameters and loop variables
+program = [
+    {"function": "f", "params": ["debug"], "do": "return $debug + 1"},
+    {"if": "$debug", "then": "set c on", "else": "set c off"},
+    "set a [f 5]",
+    {"foreach": "debug", "in": "[list 7]", "do": "set b $debug"},
+    "list $a $b $c",
+]
+for engine_class in (Engine, VMEngine):
+    e = engine_class()
+    e.eval("set debug 0")
+    assert e.eval(e.optimize(program, {"debug": 0})) == [6, 7, "off"]
+
+# an if or while whose condition is known is gone before it runs
+e = Engine()
+compiled = e.optimize([{"if": "$debug", "then": "say on", "else": "quote off"},
+                       {"while": "$debug and 1", "do": "say never"}], {"debug": 0})
+with e.profile() as profiler:
+    assert e.eval(compiled) is None
+assert not any(label.startswith("block") for label in profiler.stats), profiler.stats
+
+
+# overridden builtins get their line as a string
+class Shouting(Engine):
+    def func_say(self, line):
+        return line.upper()
+
+
+e = Shouting()
+assert e.eval(e.optimize("say hi (1 + 1)")) == "HI (1 + 1)"
+assert Engine().eval(Engine().optimize(["set x 2", "quote hi ($x * 3) (2 + 2)"])) == "hi 6 4"
+
+
+def output(engine, code):
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        engine.eval(code)
+    return out.getvalue()
+
+
+# compiling doesn't change what a program does, including what it prints
+expected = output(Engine(), smoke)
+e = Engine()
+assert output(e, e.compile(smoke)) == expected
+
+# nor when an error is waiting in a branch that isn't taken
+e = Engine()
+compiled = e.compile({"if": "$flag", "then": {"nosuch": 1}, "else": "quote ok"})
+e.eval("set flag 0")
+assert e.eval(compiled) == "ok"
+e.eval("set flag 1")
+try:
+    e.eval(compiled)
+except ValueError:
+    pass
+else:
+    raise AssertionError("no block nosuch")
+
+# the VM prints what Engine prints, compiled or not
+assert output(VMEngine(), smoke) == expected
+e = VMEngine()
+assert output(e, e.compile(smoke)) == expected
+
+# done, next and return unwinding through loops and function frames
+unwinding = [
+    "set s \"\"",
+    {"function": "find", "params": ["xs", "t"], "do": [
+        {"foreach": "x", "in": "$xs", "do": {"if": "$x == $t", "then": "return $x", "else": None}},
+        "return none"]},
+    {"function": "skip", "params": ["i"], "do": {"if": "$i == 2", "then": "next", "else": None}},
+    {"foreach": "i", "in": "0 to 9", "do": [
+        "skip $i",
+        {"if": "$i == 5", "then": "done", "else": None},
+        {"if": "$i == 3", "then": "set x [next]", "else": None},
+        "set j 0",
+        {"while": "1", "do": [{"if": "$j == $i", "then": "done", "else": None}, "set j $j + 1"]},
+        "set s [quote ($s)($i)($j)]"]},
+    "list $s [find [list 1 2 3] 2] [find [list 1] 5]",
+]
+assert Engine().eval(unwinding) == ["001144", 2, "none"]
+assert VMEngine().eval(unwinding) == ["001144", 2, "none"]
+
+# statement-level calls on the VM don't use Python's stack
+deep = [
+    "set total 0",
+    {"function": "down", "params": ["n"], "do": [
+        "set total $total + 1",
+        {"if": "$n > 0", "then": "down $n - 1", "else": None}]},
+    "down 20000",
+    "set total",
+]
+recursion_limit = sys.getrecursionlimit()
+sys.setrecursionlimit(1000)
+try:
+    assert VMEngine().eval(deep) == 20001
+finally:
+    sys.setrecursionlimit(recursion_limit)
+
+# an unknown block is only an error if the VM gets to it
+e = VMEngine()
+e.eval("set flag 0")
+assert e.eval({"if": "$flag", "then": {"nosuch": 1}, "else": "quote ok"}) == "ok"
+
+# the profiler sees user function calls on the VM too
+for engine_class in (Engine, VMEngine):
+    e = engine_class()
+    with e.profile() as profiler:
+        e.eval([{"function": "fib", "params": ["n"], "do": [
+            {"if": "$n < 2", "then": "return $n", "else": "return [fib $n - 1] + [fib $n - 2]"}]},
+            "fib 10", {"lambda": [], "do": "return 1"}, "call $result"])
+    calls = {label: stats[0] for label, stats in profiler.stats.items() if label.startswith("call ")}
+    assert calls == {"call fib": 177, "call <lambda>": 1}, (engine_class, calls)
+
+# editing a line gives the same tokens and tree as parsing the result afresh
+atoms = Engine().operator_atoms
+
+
+def fresh(line, atoms, kind):
+    try:
+        match kind:
+            case "interpolate":
+                return list(parse_interpolated(line, atoms))
+            case "expr":
+                return parse2(line, atoms, "()")
+            case "call":
+                return parse2(line, atoms, "[]")
+    except Exception as e:
+        return type(e)
+
+
+pieces = ["1", "23", "4.5", "e", "x", "foo", "$", "+", "-", "*", "==", "is in", "is", "in", "and",
+          " ", " ", "  ", "(", ")", "[", "]", "\"", "'", "\\", "true", "nil"]
+rng = random.Random(18)
+for kind in ("interpolate", "expr", "call"):
+    for _ in range(300):
+        line = "".join(rng.choices(pieces, k=rng.randrange(12)))
+        try:
+            parser = IncrementalParser(line, atoms, kind)
+        except Exception:
+            continue
+        for _ in range(8):
+            start = rng.randrange(len(line) + 1)
+            end = rng.randrange(start, len(line) + 1)
+            text = "".join(rng.choices(pieces, k=rng.randrange(3)))
+            new_line = line[:start] + text + line[end:]
+            try:
+                tokens = list(get_tokenizer(atoms).tokenize(new_line))
+            except Exception:
+                break
+            try:
+                result = parser.edit(start, end, text)
+            except Exception as e:
+                result = type(e)
+            line = new_line
+            assert [(t.start, t.end, t.source) for t in parser.tokens] == \
+                [(t.start, t.end, t.source) for t in tokens], (line, start, end, text)
+            assert result == fresh(line, atoms, kind), (line, start, end, text)
+
+# the disk cache gives a new engine what an earlier one parsed
+cached = [
+    "set x 2",
+    {"function": "f", "params": ["a"], "do": "return $a * $x"},
+    {"foreach": "i", "in": "1 to 3", "do": "set x $x + $i"},
+    "list [f 3] [quote x is ($x) and (1 + 2)] [f ($x - 1)] \"a b\"",
+]
+with tempfile.TemporaryDirectory() as directory:
+    first = Engine()
+    assert first.eval_cached(cached, directory) == [15, "x is 5 and 3", 20, "a b"]
+    files = os.listdir(directory)
+    assert len(files) == 1 and files[0].endswith(".jrpc"), files
+    path = os.path.join(directory, files[0])
+    with open(path, "rb") as f:
+        saved = f.read()
+
+    second = Engine()
+    assert second.eval_cached(cached, directory) == [15, "x is 5 and 3", 20, "a b"]
+    assert second.parse_cache.misses == 0
+    cache = DiskCache(directory)
+    assert cache.load(Engine(), cached)
+    assert cache.trees and all(Engine().parse(text, kind) == tree for (text, kind), tree in cache.trees.items())
+    # nothing new was parsed, so the file is left alone
+    with open(path, "rb") as f:
+        assert f.read() == saved
+
+    # a damaged, cut short or empty file is parsed again and written afresh
+    for damaged in (saved[:-1] + bytes([saved[-1] ^ 1]), saved[:len(saved) // 2], b""):
+        with open(path, "wb") as f:
+            f.write(damaged)
+        e = Engine()
+        assert not DiskCache(directory).load(e, cached)
+        assert e.eval_cached(cached, directory) == [15, "x is 5 and 3", 20, "a b"]
+        assert e.parse_cache.misses
+        with open(path, "rb") as f:
+            assert f.read() == saved
+
+    # a program with more lines than the engine's parse cache holds is
+    # still parsed only once
+    class Small(Engine):
+        parse_cache_size = 16
+    big = [f"set x [quote line {i}]" for i in range(100)]
+    assert Small().eval_cached(big, directory) == "line 99"
+    with open(DiskCache(directory).path(Small(), big), "rb") as f:
+        saved_big = f.read()
+    e = Small()
+    assert e.eval_cached(big, directory) == "line 99"
+    assert e.parse_cache.misses == 0
+    with open(DiskCache(directory).path(Small(), big), "rb") as f:
+        assert f.read() == saved_big
+
+    # an engine with other operators gets a file of its own
+    class Caret(Engine):
+        def op_1000_caret(self, x, y):
+            return x ** y
+    assert DiskCache(directory).path(Caret(), cached) != path
+    assert not DiskCache(directory).load(Caret(), cached)
+
+# a template changed after it has run expands to what it is now
+for engine_class in (Engine, VMEngine):
+    assert engine_class().eval([
+        {"function": "f", "params": [], "do": {"template": {"a": 1, "b": {"insert": "quote x"}}}},
+        "f",
+        "setsub ($f.body.template) a 2",
+        "f"]) == {"a": 2, "b": "x"}
+
+# a subclass's func_done, func_next and func_return are called, not
+# skipped by the fast path
+signalled = [
+    {"function": "f", "params": [], "do": ["return 5", "return 6"]},
+    "set n 0",
+    {"foreach": "i", "in": "0 to 5", "do": ["next", "set n $n + 1", {"if": "$i == 3", "then": "done", "else": None}]},
+    "list [f] $n",
+]
+for engine_class in (Engine, VMEngine, AsyncEngine):
+    class Logging(engine_class):
+        def __init__(self):
+            super().__init__()
+            self.log = []
+
+        def func_next(self, line):
+            # carries on instead
+            self.log.append("next")
+
+        def func_done(self, line):
+            self.log.append("done")
+            return super().func_done(line)
+
+        def func_return(self, line):
+            self.log.append("return")
+            return super().func_return(line)
+    for compiled in (False, True):
+        e = Logging()
+        code = e.compile(signalled) if compiled else signalled
+        result = asyncio.run(e.aeval(code)) if engine_class is AsyncEngine else e.eval(code)
+        assert result == [5, 4], (engine_class, compiled, result)
+        assert e.log == ["next"] * 4 + ["done", "return"], (engine_class, compiled, e.log)
+
+# scopes pushed, popped or swapped on scope_stack by the host are seen
+for engine_class in (Engine, VMEngine):
+    e = engine_class()
+    e.eval("set x 1")
+    seen = [e.eval("set y $x")]
+    e.scope_stack.append({"x": 2})
+    seen.append(e.eval("set y $x"))
+    e.scope_stack.pop()
+    seen.append(e.eval("set y $x"))
+    e.scope_stack[-1] = {"x": 3}
+    seen.append(e.eval("set y $x"))
+    assert seen == [1, 2, 1, 3], seen
+
+# a silenced line still runs what printing it would have run
+for engine_class in (Engine, AsyncEngine):
+    calls = []
+    for line in ("say mapped ($m)", "silently say mapped ($m)"):
+        e = engine_class()
+        e.output = [].append
+        program = [{"function": "f", "params": ["x"], "do": ["set calls $calls + 1", "return $x"]},
+                   "set calls 0",
+                   "set m [map $f [list 1 2 3]]",
+                   line,
+                   "set calls"]
+        calls.append(asyncio.run(e.aeval(program)) if engine_class is AsyncEngine else e.eval(program))
+    assert calls[0] == calls[1] > 0, calls
+    try:
+        e.eval("silently say ($nosuch)")
+    except UnboundLocalError:
+        pass
+    else:
+        raise AssertionError("undefined variable in a silenced line went unnoticed")
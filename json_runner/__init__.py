@@ -1,11 +1,16 @@
+import functools
+import heapq
 import itertools
 import random
-from collections import OrderedDict
+import threading
+from collections import OrderedDict, deque
 import time
 
-from .string_parsing import Expression, FunctionCall, parse2, parse_interpolated
+from .compiler import Compiled, compile_code
+from .string_parsing import Expression, FunctionCall, LRUCache, parse2, parse_interpolated
+from .templates import Template
 
-__all__ = "parse Signal Done Next Abort Return BareEngine Engine".split()
+__all__ = "parse Signal Done Next Abort Return LimitExceeded LazySeq BareEngine Engine".split()
 
 
 PYTHONIZE_MAP = {
@@ -53,69 +58,364 @@ class Abort(Signal):
     pass
 
 
+class LimitExceeded(Signal):
+    def __init__(self, message, limit, usage):
+        super().__init__(message, limit, usage)
+        self.limit = limit
+        self.usage = usage
+
+    def __str__(self):
+        return self.args[0]
+
+
+class Frame:
+    __slots__ = ("base", "names")
+
+    def __init__(self, base, names):
+        self.base = base
+        self.names = names
+
+
+def _block_spec(name):
+    keys = name.removeprefix("block_").split("_")
+    return frozenset(keys), (name, len(keys))
+
+
+def _op_text(name):
+    for punctuation, python in PYTHONIZE_MAP.items():
+        name = name.replace(python, punctuation)
+    return name
+
+
+def _op_spec(name):
+    precedence, text = name.removeprefix("op_").split("_", 1)
+    return int(precedence), _op_text(text.replace("_", " ")), name
+
+
+def _install(engine, wrappers):
+    # the profiler and the limits put their wrappers in the engine's
+    # __dict__, over whatever is there already (which may be the other's)
+    saved = {attr: engine.__dict__.get(attr, _MISSING) for attr in wrappers}
+    engine.__dict__.update(wrappers)
+    engine._op_state = engine._block_state = None
+    return saved
+
+
+def _uninstall(engine, wrappers, saved):
+    # and put that back when they are taken off, which has to happen in the
+    # opposite order, or the one put on later would be left wrapping
+    # wrappers that are gone
+    if any(engine.__dict__.get(attr) is not wrapper for attr, wrapper in wrappers.items()):
+        raise RuntimeError("detach what was attached to the engine after this first")
+    for attr, previous in saved.items():
+        if previous is _MISSING:
+            del engine.__dict__[attr]
+        else:
+            engine.__dict__[attr] = previous
+    engine._op_state = engine._block_state = None
+
+
 class BareEngine:
+    _ops_generation = 0
+    _blocks_generation = 0
+    parse_cache_size = 4096
+    code_keys = frozenset()
+    expr_keys = frozenset()
+    interpolate_functions = frozenset()
+    signal_statements = {}
+
     def __init__(self):
         self.scope_stack = [{}]
+        self.names = {}
+        self._names_depth, self._names_top = 1, self.scope_stack[-1]
+        self.pending = None
+        self.limits = None
+        self._op_state = None
+        self._block_state = None
+        self.parse_cache = LRUCache(self.parse_cache_size)
+
+    @classmethod
+    def operator_table(cls):
+        table = cls.__dict__.get("_op_table")
+        if table is None or table[0] != BareEngine._ops_generation:
+            specs = sorted(map(_op_spec, (n for n in dir(cls) if n.startswith("op_"))),
+                           key=lambda x: x[0])
+            table = (BareEngine._ops_generation, tuple(specs))
+            cls._op_table = table
+        return table[1]
+
+    @classmethod
+    def invalidate_ops(cls):
+        BareEngine._ops_generation += 1
+
+    def _get_op_state(self):
+        state = self._op_state
+        if state is None or state[0] != BareEngine._ops_generation:
+            specs = type(self).operator_table()
+            if any(n.startswith("op_") for n in vars(self)):
+                specs = sorted(map(_op_spec, (n for n in dir(self) if n.startswith("op_"))),
+                               key=lambda x: x[0])
+            ops = OrderedDict((text, getattr(self, name)) for _, text, name in specs)
+            groups = OrderedDict()
+            for precedence, text, _ in specs:
+                groups.setdefault(precedence, []).append(text)
+            state = (BareEngine._ops_generation, ops,
+                     tuple((p, tuple(t)) for p, t in groups.items()),
+                     frozenset(ops),
+                     {text: i for i, text in enumerate(ops)},
+                     tuple(ops.values()))
+            self._op_state = state
+        return state
+
+    @classmethod
+    def blocks_table(cls):
+        table = cls.__dict__.get("_block_table")
+        if table is None or table[0] != BareEngine._blocks_generation:
+            blocks = dict(map(_block_spec, (n for n in dir(cls) if n.startswith("block_"))))
+            table = (BareEngine._blocks_generation, blocks)
+            cls._block_table = table
+        return table[1]
+
+    @classmethod
+    def invalidate_blocks(cls):
+        BareEngine._blocks_generation += 1
+
+    @property
+    def blocks(self):
+        state = self._block_state
+        if state is None or state[0] != BareEngine._blocks_generation:
+            blocks = type(self).blocks_table()
+            if any(n.startswith("block_") for n in vars(self)):
+                blocks = dict(map(_block_spec, (n for n in dir(self) if n.startswith("block_"))))
+            state = self._block_state = (BareEngine._blocks_generation, blocks)
+        return state[1]
+
+    @classmethod
+    def signal_table(cls):
+        # signal_statements set pending instead of calling their func_,
+        # which only does the same thing while that func_ is the one that
+        # goes with them; a subclass's override is called like any builtin
+        table = cls.__dict__.get("_signal_table")
+        if table is None:
+            table = cls._signal_table = {name: signal for name, signal in cls.signal_statements.items()
+                                         if not cls._overrides_signal(name)}
+        return table
+
+    @classmethod
+    def _overrides_signal(cls, name):
+        owner = next(c for c in cls.__mro__ if "signal_statements" in vars(c))
+        return getattr(cls, "func_" + name, None) is not getattr(owner, "func_" + name, None)
 
     @property
     def ops(self):
-        names = [x for x in dir(self) if x.startswith("op_")]
-        precedence_name_method = [(int((s := n.removeprefix("op_").split("_", 1))[0]), s[1], n)
-                                  for n in names]
-        sorted_pnm = sorted(precedence_name_method, key=lambda x: x[0])
-        op_names = [x[1].replace("_", " ") for x in sorted_pnm]
-        for i, o in enumerate(op_names):
-            for punctuation, python in PYTHONIZE_MAP.items():
-                o = o.replace(python, punctuation)
-            op_names[i] = o
-        callbacks = [getattr(self, x[2]) for x in sorted_pnm]
-        return OrderedDict(zip(op_names, callbacks))
+        return self._get_op_state()[1]
+
+    @property
+    def operator_groups(self):
+        return self._get_op_state()[2]
+
+    @property
+    def operator_atoms(self):
+        return self._get_op_state()[3]
+
+    def parse(self, text, kind):
+        atoms = frozenset() if kind == "call" else self.operator_atoms
+        key = (text, atoms, kind)
+        tree = self.parse_cache.get(key)
+        if tree is None:
+            match kind:
+                case "expr":
+                    tree = parse2(text, atoms, "()")
+                case "call":
+                    tree = parse2(text, atoms, "[]")
+                case "interpolate":
+                    tree = tuple(parse_interpolated(text, atoms))
+                case _:
+                    raise ValueError(f"unknown parse kind {kind!r}")
+            self.parse_cache.put(key, tree)
+        return tree
 
     def eval(self, code):
+        value = self._eval(code)
+        if self.pending is not None:
+            signal, self.pending = self.pending, None
+            raise signal
+        return value
+
+    def _eval(self, code):
+        # statements named in signal_table() (done, next, return) don't
+        # raise here, they leave the signal in self.pending and everything
+        # up to the enclosing loop or function returns straight away;
+        # eval() turns a leftover pending signal back into the exception
         match code:
             case str():
                 code = code.strip()
                 if not code:
                     return None
-                return self.call_function(code)
+                call = self.parse(code, "call")
+                signal = self.signal_table().get(call.name)
+                if signal is not None:
+                    return self._signal(signal, call.arg)
+                return self.call_function(call.name, call.arg)
             case list() | tuple():
-                self.scope_stack[-1]["result"] = None
+                self.reset_result()
                 for item in code:
-                    self.set("result", self.eval(item))
+                    value = self._eval(item)
+                    if self.pending is not None:
+                        return value
+                    self.set("result", value)
                 return self.get("result")
             case dict():
-                k = code.keys()
-                # try all permutations if they wrote it in a different order
-                for p in itertools.permutations(k):
-                    n = "block_" + "_".join(p)
-                    if hasattr(self, n):
-                        return getattr(self, n)(code)
-                raise ValueError(
-                    f"no block {'_'.join(p)} in {type(self).__name__}")
+                return getattr(self, self.find_block(code))(code)
+            case Compiled():
+                return code.run(self)
             case _:
                 return code
 
+    def _signal(self, signal, line):
+        self.pending = signal()
+
+    def _take_loop_signal(self):
+        signal = self.pending
+        if isinstance(signal, (Done, Next)):
+            self.pending = None
+        return signal
+
+    def find_block(self, code):
+        blocks = self.blocks
+        # blocks are looked up by their set of keys, so they can be written
+        # in any order; keys that themselves contain underscores are split
+        # up the same way the handler names are
+        name, length = blocks.get(frozenset(code), (None, 0))
+        if length == len(code):
+            return name
+        parts = [p for k in code for p in k.split("_")]
+        name, length = blocks.get(frozenset(parts), (None, 0))
+        if length == len(parts):
+            return name
+        keys = frozenset(parts)
+        near = max(blocks, key=lambda k: len(k & keys), default=frozenset())
+        hint = f" (did you mean {blocks[near][0]}?)" if near & keys else ""
+        raise ValueError(
+            f"no block {'_'.join(code)} in {type(self).__name__}{hint}")
+
+    def compile(self, code):
+        return compile_code(self, code)
+
+    def optimize(self, code, frozen=None):
+        from .optimizer import Optimizer
+        return compile_code(self, code, Optimizer(self, frozen))
+
+    def eval_stream(self, fp, format="auto"):
+        from .streaming import iter_statements
+        self.reset_result()
+        for statement in iter_statements(fp, format):
+            self.set("result", self.eval(statement))
+        return self.get("result")
+
+    def eval_cached(self, code, directory):
+        from .diskcache import DiskCache
+        cache = DiskCache(directory)
+        cache.load(self, code)
+        try:
+            with cache.attach(self):
+                return self.eval(code)
+        finally:
+            if cache.changed:
+                cache.save(self, code)
+
+    def expr_batch(self, tree, columns):
+        from .batch import expr_batch
+        return expr_batch(self, tree, columns)
+
+    def profile(self):
+        from .profiler import Profiler
+        return Profiler().attach(self)
+
+    def limit(self, **limits):
+        from .limits import Limits
+        return Limits(**limits).attach(self)
+
     def _reduce_expression(self, tokens):
-        tokens = list(itertools.chain.from_iterable(map(self._apply_ast_node, tokens)))
-        while True:
-            for text_op, op_func in self.ops.items():
-                tokens.insert(0, None)
-                tokens.append(None)
-                try:
-                    i = tokens.index(text_op)
-                    val = op_func(tokens[i-1], tokens[i+1])
-                    tokens[i-1:i+2] = val if isinstance(val, list) else [val]
-                    break
-                except ValueError:
-                    continue
-                finally:
-                    assert tokens.pop(
-                        0) is None, "postfix operator not allowed at beginning"
-                    assert tokens.pop(
-                    ) is None, "prefix operator not allowed at end"
-            else:
-                break
-        return tokens
+        return self._reduce_values(list(itertools.chain.from_iterable(map(self._apply_ast_node, tokens))))
+
+    def _reduce_values(self, tokens, callbacks=None):
+        _, _, _, _, ranks, default = self._get_op_state()
+        if callbacks is None:
+            callbacks = default
+        # doubly linked list of tokens padded with None on both ends; the
+        # operators waiting to be applied are kept in a heap ordered by
+        # (position in self.ops, position in the expression), which is the
+        # same order the old rescanning loop picked them in
+        values = [None, *tokens, None]
+        prev = list(range(-1, len(values) - 1))
+        next_ = list(range(1, len(values))) + [-1]
+        order = list(range(len(values)))
+        alive = [True] * len(values)
+        head, tail = 0, len(values) - 1
+
+        def is_op(value):
+            return isinstance(value, str) and value in ranks
+
+        heap = [(ranks[v], i, i) for i, v in enumerate(values) if is_op(v)]
+        heapq.heapify(heap)
+        while heap:
+            rank, pos, i = heapq.heappop(heap)
+            if not alive[i] or order[i] != pos:
+                continue
+            left, right = prev[i], next_[i]
+            val = callbacks[rank](values[left], values[right])
+            new = val if isinstance(val, list) else [val]
+            before, after = prev[left], next_[right]
+            alive[left] = alive[i] = alive[right] = False
+            # spliced-in tokens are numbered between their new neighbours so
+            # any operators among them still sort by position
+            low = order[before] if before >= 0 else -1
+            high = order[after] if after >= 0 else low + len(new) + 1
+            step = (high - low) / (len(new) + 1)
+            first = len(values) if new else after
+            last = before
+            for n, item in enumerate(new, 1):
+                values.append(item)
+                prev.append(last)
+                next_.append(len(values))
+                order.append(low + step * n)
+                alive.append(True)
+                last = len(values) - 1
+                if is_op(item):
+                    heapq.heappush(heap, (ranks[item], order[last], last))
+            if last >= 0:
+                next_[last] = after
+            if after >= 0:
+                prev[after] = last
+            if before >= 0:
+                next_[before] = first
+            if left == head:
+                head = first
+            if right == tail:
+                tail = last
+            if head < 0:
+                raise IndexError("pop from empty list")
+            assert values[head] is None, "postfix operator not allowed at beginning"
+            if head == tail:
+                raise IndexError("pop from empty list")
+            assert values[tail] is None, "prefix operator not allowed at end"
+            if new and not low < order[first] <= order[last] < high:
+                # ran out of float precision between two neighbours; renumber
+                heap.clear()
+                i, pos = head, 0
+                while i >= 0:
+                    order[i] = pos
+                    if is_op(values[i]):
+                        heap.append((ranks[values[i]], pos, i))
+                    i, pos = next_[i], pos + 1
+                heapq.heapify(heap)
+        out = []
+        i = next_[head]
+        while i != tail:
+            out.append(values[i])
+            i = next_[i]
+        return out
 
     def _apply_ast_node(self, node):
         match node:
@@ -128,14 +428,14 @@ class BareEngine:
 
     def expr(self, tree):
         if isinstance(tree, str):
-            tree = parse2(tree, self.ops.keys(), "()")
+            tree = self.parse(tree, "expr")
             assert isinstance(tree, Expression), "bad parse"
         items = self._reduce_expression(tree.elements)
         return items
 
     def call_function(self, name, arg=None):
         if arg is None:
-            result = parse2(name, [], "[]")
+            result = self.parse(name, "call")
             name, arg = result.name, result.arg
         if hasattr(self, "func_" + name):
             return getattr(self, "func_" + name)(arg.strip())
@@ -146,46 +446,120 @@ class BareEngine:
         return (isinstance(func, dict)
                 and sorted(func.keys()) == ['body', 'closure', 'params'])
 
-    def call_user_function(self, name, args):
+    def resolve_function(self, name):
         if self._test_function(name):
-            func = name
-        else:
-            try:
-                func = self.get(name)
-                if not self._test_function(func):
-                    raise NameError(name)
-            except UnboundLocalError as e:
-                raise NameError(name) from e
-        orig_len = len(self.scope_stack)
+            return name
+        try:
+            func = self.get(name)
+            if not self._test_function(func):
+                raise NameError(name)
+        except UnboundLocalError as e:
+            raise NameError(name) from e
+        return func
+
+    def enter_function(self, func, args):
+        self._check_names()
+        frame = Frame(len(self.scope_stack), self.names)
         self.scope_stack.append(None)
         self.scope_stack.extend(func['closure'])
         self.scope_stack.append(
             {"args": args} | dict(zip(func['params'], args)))
+        self._forget_names()
+        return frame
+
+    def leave_function(self, frame):
+        stack = self.scope_stack
+        del stack[frame.base:]
+        self.names = frame.names
+        self._names_depth, self._names_top = len(stack), stack[-1]
+
+    def call_user_function(self, name, args):
+        func = self.resolve_function(name)
+        frame = self.enter_function(func, args)
         try:
-            return self.eval(func['body'])
+            value = self._eval(func['body'])
         except Return as r:
             return r.args[0]
         finally:
-            del self.scope_stack[orig_len:]
-
-    def get(self, var):
+            self.leave_function(frame)
+        if self.pending is not None:
+            signal, self.pending = self.pending, None
+            if isinstance(signal, Return):
+                return signal.args[0]
+            raise signal
+        return value
+
+    # self.names maps each variable the current function frame has used to
+    # the scope dict that holds it, so only the first lookup walks the
+    # stack. Within a frame only the top scope ever gains new variables, so
+    # a resolved name can't be shadowed later as long as writes to the top
+    # scope go through set() or reset_result(). A host that pushes, pops or
+    # replaces scopes on scope_stack itself changes its length or its top
+    # scope, which is checked for before names is used.
+
+    def _forget_names(self):
+        stack = self.scope_stack
+        self.names = {}
+        self._names_depth, self._names_top = len(stack), stack[-1]
+
+    def _check_names(self):
+        stack = self.scope_stack
+        if len(stack) != self._names_depth or stack[-1] is not self._names_top:
+            self._forget_names()
+
+    def _resolve(self, var):
         for scope in reversed(self.scope_stack):
             if scope is None:
                 break
-            try:
-                return scope[var]
-            except KeyError:
-                continue
-        raise UnboundLocalError("no var $%s" % var)
+            if var in scope:
+                self.names[var] = scope
+                return scope
+        return None
+
+    def get(self, var):
+        stack = self.scope_stack
+        if len(stack) != self._names_depth or stack[-1] is not self._names_top:
+            self._forget_names()
+        scope = self.names.get(var) or self._resolve(var)
+        if scope is None:
+            raise UnboundLocalError("no var $%s" % var)
+        return scope[var]
 
     def set(self, var, value):
-        for scope in reversed(self.scope_stack):
-            if scope is None:
+        stack = self.scope_stack
+        if len(stack) != self._names_depth or stack[-1] is not self._names_top:
+            self._forget_names()
+        scope = self.names.get(var) or self._resolve(var)
+        if scope is None:
+            scope = self.names[var] = self.scope_stack[-1]
+        scope[var] = value
+
+    def reset_result(self):
+        self._check_names()
+        scope = self.names["result"] = self.scope_stack[-1]
+        scope["result"] = None
+
+    def snapshot_scope(self):
+        scope = {}
+        for s in reversed(self.scope_stack):
+            if s is None:
                 break
-            if var in scope:
-                scope[var] = value
-                return
-        self.scope_stack[-1][var] = value
+            for var, value in s.items():
+                scope.setdefault(var, value)
+        return scope
+
+    def fork(self, scope=None):
+        # a new execution context (variables, pending signal) that shares
+        # this engine's caches; compiled programs can be run on any number
+        # of forks at once, from different threads
+        engine = type(self)()
+        engine.parse_cache = self.parse_cache
+        if self.limits is not None:
+            # forks count towards the same budget
+            self.limits.attach(engine)
+        if scope is not None:
+            engine.scope_stack = [scope]
+        return engine
 
     def make_lambda(self, params, body):
         if None in self.scope_stack:
@@ -204,23 +578,117 @@ class BareEngine:
         return lambda_
 
 
+def _run_iteration(engine, scope, var, body, item):
+    engine.scope_stack = [dict(scope)]
+    engine._forget_names()
+    engine.pending = None
+    engine.set(var, item)
+    try:
+        return "ok", engine.eval(body)
+    except Next:
+        return "next", None
+    except Done:
+        return "done", None
+
+
+_process_engines = {}
+
+
+def _run_process_iteration(cls, scope, var, body, item):
+    engine = _process_engines.get(cls)
+    if engine is None:
+        engine = _process_engines[cls] = cls()
+    return _run_iteration(engine, scope, var, body, item)
+
+
+class LazySeq:
+    __slots__ = ("_factory",)
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __iter__(self):
+        return iter(self._factory())
+
+    # no __len__, which list() and friends would call first and so walk
+    # the sequence twice; # counts it itself
+    def __bool__(self):
+        return next(iter(self), _MISSING) is not _MISSING
+
+    def __getitem__(self, index):
+        if isinstance(index, int) and index >= 0:
+            try:
+                return next(itertools.islice(self, index, None))
+            except StopIteration:
+                raise IndexError("lazy sequence index out of range") from None
+        return list(self)[index]
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+_MISSING = object()
+_PLAIN_TEXT = frozenset({str, int, float, bool, type(None)})
+
+
 class Engine(BareEngine):
+    code_keys = frozenset({"then", "else", "do"})
+    expr_keys = frozenset({"if", "while", "in", "workers"})
+    interpolate_functions = frozenset({"say", "puts", "quote", "ask", "confirm"})
+    signal_statements = {"done": Done, "next": Next, "return": Return}
+
+    parallel_workers = 4
+    template_cache_size = 1024
+
     def __init__(self):
         super().__init__()
         self.silenced = False
+        self.output = None
         self.rng = random.Random()
+        self.template_cache = LRUCache(self.template_cache_size)
+
+    def fork(self, scope=None):
+        engine = super().fork(scope)
+        engine.silenced = self.silenced
+        engine.output = self.output
+        engine.template_cache = self.template_cache
+        return engine
 
-    def print(self, *a, **k):
+    def print(self, *a, sep=" ", end="\n", **k):
         if self.silenced:
             return
-        print(*a, **k)
+        if self.output is None or k:
+            print(*a, sep=sep, end=end, **k)
+            return
+        write = getattr(self.output, "write", self.output)
+        write(sep.join(map(str, a)) + end)
+
+    def flush_output(self):
+        flush = getattr(self.output, "flush", None)
+        if flush is not None:
+            flush()
+
+    def interpolation(self, line):
+        # optimized programs hand builtins in interpolate_functions their
+        # line already parsed
+        return self.parse(line, "interpolate") if isinstance(line, str) else line
 
     def interpolate(self, line):
-        it = parse_interpolated(line, self.ops.keys())
+        it = self.interpolation(line)
         it = (self._apply_ast_node(ex) for ex in it)
         return "".join(map(str, itertools.chain.from_iterable(it)))
 
     def _outputcmd(self, line, **kwargs):
+        if self.silenced:
+            # nothing is printed, but the line is still worked out for its
+            # calls and errors; only turning it into text is left out, where
+            # that can't run anything (a lazy sequence runs its functions
+            # then, and other objects have their own __str__)
+            it = (self._apply_ast_node(ex) for ex in self.interpolation(line))
+            for value in itertools.chain.from_iterable(it):
+                if type(value) not in _PLAIN_TEXT:
+                    str(value)
+            return
         self.print(self.interpolate(line), **kwargs)
 
     def func_say(self, line): self._outputcmd(line)
@@ -247,7 +715,7 @@ class Engine(BareEngine):
         return rv
 
     def func_list(self, line):
-        return list(self.expr(parse2(line, self.ops.keys(), "()")))
+        return list(self.expr(line))
 
     def func_setsub(self, line):
         container, key, val = self.expr(line)
@@ -265,6 +733,13 @@ class Engine(BareEngine):
         val, = self.expr(line)
         raise Return(val)
 
+    def _signal(self, signal, line):
+        if signal is Return:
+            val, = self.expr(line)
+            self.pending = Return(val)
+            return val
+        self.pending = signal()
+
     def func_eval(self, line):
         item, = self.expr(line)
         return self.eval(item)
@@ -276,12 +751,14 @@ class Engine(BareEngine):
         return self.interpolate(line)
 
     def func_ask(self, line):
+        self.flush_output()
         return input(self.interpolate(line) + " ")
 
     def func_confirm(self, line):
         yes = ["y", "yes"]
         no = ["n", "no"]
         while True:
+            self.flush_output()
             ans = input(self.interpolate(line) + " (y/n) ").lower()
             if ans in yes:
                 return True
@@ -292,22 +769,45 @@ class Engine(BareEngine):
         func, *args = self.expr(line)
         return self.call_user_function(func, args)
 
+    def func_map(self, line):
+        func, seq = self.expr(line)
+        func = self.resolve_function(func)
+        return LazySeq(lambda: (self.call_user_function(func, [x]) for x in seq))
+
+    def func_filter(self, line):
+        func, seq = self.expr(line)
+        func = self.resolve_function(func)
+        return LazySeq(lambda: (x for x in seq if self.call_user_function(func, [x])))
+
+    def func_take(self, line):
+        count, seq = self.expr(line)
+        return LazySeq(lambda: itertools.islice(seq, count))
+
+    def func_zip(self, line):
+        seqs = self.expr(line)
+        return LazySeq(lambda: zip(*seqs))
+
     def block_if_then_else(self, block):
         cond, = self.expr(block['if'])
         if cond:
-            return self.eval(block['then'])
-        return self.eval(block['else'])
+            return self._eval(block['then'])
+        return self._eval(block['else'])
 
     def block_while_do(self, block):
         result = None
         cond, = self.expr(block['while'])
         while cond:
             try:
-                result = self.eval(block['do'])
+                value = self._eval(block['do'])
             except Next:
                 continue
             except Done:
                 break
+            if (signal := self._take_loop_signal()) is not None:
+                if isinstance(signal, Next):
+                    continue
+                break
+            result = value
             cond, = self.expr(block['while'])
         return result
 
@@ -317,13 +817,66 @@ class Engine(BareEngine):
         for i in l:
             self.set(block['foreach'], i)
             try:
-                result = self.eval(block['do'])
+                value = self._eval(block['do'])
             except Next:
                 continue
             except Done:
                 break
+            if (signal := self._take_loop_signal()) is not None:
+                if isinstance(signal, Next):
+                    continue
+                break
+            result = value
         return result
 
+    def block_parallel_foreach_in_do(self, block):
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        l, = self.expr(block['in'])
+        workers = block.get('workers', self.parallel_workers)
+        if not isinstance(workers, int):
+            workers, = self.expr(workers)
+        var, body, scope = block['parallel_foreach'], block['do'], self.snapshot_scope()
+        match block.get('pool', "threads"):
+            case "threads":
+                body = self.compile(body)
+                local = threading.local()
+
+                def run(item):
+                    engine = getattr(local, "engine", None)
+                    if engine is None:
+                        engine = local.engine = self.fork({})
+                    return _run_iteration(engine, scope, var, body, item)
+                executor = ThreadPoolExecutor(workers)
+            case "processes":
+                run = functools.partial(_run_process_iteration, type(self), scope, var, body)
+                executor = ProcessPoolExecutor(workers)
+            case pool:
+                raise ValueError(f"unknown pool {pool!r}")
+        # only a few iterations are queued ahead of the one being waited
+        # for, so a lazy "in" sequence is never read all at once; results
+        # are collected in order, and the first done or error in that order
+        # wins even if later iterations finished before it
+        items = iter(l)
+        queued = deque(executor.submit(run, i) for i in itertools.islice(items, 2 * workers))
+        results = []
+        try:
+            while queued:
+                future = queued.popleft()
+                for i in itertools.islice(items, 1):
+                    queued.append(executor.submit(run, i))
+                status, value = future.result()
+                if status == "done":
+                    break
+                if status == "ok":
+                    results.append(value)
+        finally:
+            executor.shutdown(cancel_futures=True)
+        return results
+
+    block_parallel_foreach_in_do_workers = block_parallel_foreach_in_do
+    block_parallel_foreach_in_do_pool = block_parallel_foreach_in_do
+    block_parallel_foreach_in_do_workers_pool = block_parallel_foreach_in_do
+
     def block_function_params_do(self, block):
         lambda_ = self.make_lambda(block['params'], block['do'])
         self.set(block['function'], lambda_)
@@ -360,8 +913,21 @@ class Engine(BareEngine):
             case _:
                 return val
 
+    def plan_template(self, template):
+        # keyed on identity like VMEngine.assemble; the template is kept in
+        # the entry so its id can't be reused while it is cached, and checked
+        # against the plan in case it has been changed since
+        entry = self.template_cache.get(id(template))
+        if entry is None or entry[0] is not template or not entry[1].matches(template):
+            entry = self.template_cache.put(id(template), (template, Template(template)))
+        return entry[1]
+
     def block_template(self, block):
-        return self.recursive_interpolate(block['template'])
+        template = self.plan_template(block['template'])
+        out = template.new()
+        for path, code in template.holes:
+            out = template.put(out, path, self.eval(code))
+        return out
 
     def op_0_DOLLAR(self, left, right): return [left, self.get(right)]
 
@@ -379,7 +945,8 @@ class Engine(BareEngine):
         except TypeError:
             return [left, right]
 
-    def op_100_HASH(self, left, right): return [left, len(right)]
+    def op_100_HASH(self, left, right):
+        return [left, sum(1 for _ in right) if isinstance(right, LazySeq) else len(right)]
     def op_200_DOTDOT(self, left, right): return [range(left, right)]
     op_200_to = op_200_DOTDOT
     def op_300_CARET(self, left, right): return [pow(left, right)]
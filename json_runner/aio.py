@@ -0,0 +1,275 @@
+import asyncio
+import inspect
+import itertools
+
+from . import Abort, Done, Engine, LazySeq, Next, Return, _PLAIN_TEXT
+from .compiler import Compiled
+from .string_parsing import Expression, FunctionCall
+
+
+class AsyncEngine(Engine):
+    # everything that evaluates code has an a-prefixed coroutine twin;
+    # builtins and blocks are looked up as afunc_*/ablock_* before
+    # func_*/block_*, and whatever a builtin returns is awaited if it can
+    # be, so host functions can be plain or async
+
+    @classmethod
+    def _overrides_signal(cls, name):
+        attr = "afunc_" + name
+        return super()._overrides_signal(name) or getattr(cls, attr, None) is not getattr(AsyncEngine, attr, None)
+
+    async def aeval(self, code):
+        value = await self._aeval(code)
+        if self.pending is not None:
+            signal, self.pending = self.pending, None
+            raise signal
+        return value
+
+    async def _aeval(self, code):
+        match code:
+            case str():
+                code = code.strip()
+                if not code:
+                    return None
+                call = self.parse(code, "call")
+                signal = self.signal_table().get(call.name)
+                if signal is not None:
+                    return await self._asignal(signal, call.arg)
+                return await self.acall_function(call.name, call.arg)
+            case list() | tuple():
+                self.reset_result()
+                for item in code:
+                    value = await self._aeval(item)
+                    if self.pending is not None:
+                        return value
+                    self.set("result", value)
+                return self.get("result")
+            case dict():
+                value = self._handler(self.find_block(code))(code)
+                if inspect.isawaitable(value):
+                    value = await value
+                return value
+            case Compiled():
+                # the compiled closures are synchronous
+                return await self._aeval(code.source)
+            case _:
+                return code
+
+    async def _asignal(self, signal, line):
+        if signal is Return:
+            val, = await self.aexpr(line)
+            self.pending = Return(val)
+            return val
+        self.pending = signal()
+
+    async def _aapply_ast_node(self, node):
+        match node:
+            case Expression():
+                return await self.aexpr(node)
+            case FunctionCall():
+                return [await self.acall_function(node.name, node.arg)]
+            case _:
+                return [node]
+
+    async def aexpr(self, tree):
+        if isinstance(tree, str):
+            tree = self.parse(tree, "expr")
+            assert isinstance(tree, Expression), "bad parse"
+        tokens = []
+        for node in tree.elements:
+            tokens.extend(await self._aapply_ast_node(node))
+        return self._reduce_values(tokens)
+
+    async def ainterpolate(self, line):
+        parts = []
+        for node in self.interpolation(line):
+            parts.extend(await self._aapply_ast_node(node))
+        return "".join(map(str, parts))
+
+    def _handler(self, attr):
+        # whichever of func_x and afunc_x (or block_x and ablock_x) the most
+        # derived class defines, so that a subclass overriding func_x isn't
+        # shadowed by the afunc_x twin here
+        for cls in type(self).__mro__:
+            if "a" + attr in cls.__dict__:
+                return getattr(self, "a" + attr)
+            if attr in cls.__dict__:
+                return getattr(self, attr)
+        return getattr(self, "a" + attr, None) or getattr(self, attr, None)
+
+    async def acall_function(self, name, arg=None):
+        if arg is None:
+            result = self.parse(name, "call")
+            name, arg = result.name, result.arg
+        func = self._handler("func_" + name)
+        if func is None:
+            return await self.acall_user_function(name, await self.aexpr(arg))
+        value = func(arg.strip())
+        if inspect.isawaitable(value):
+            value = await value
+        return value
+
+    def call_function(self, name, arg=None):
+        if arg is None:
+            result = self.parse(name, "call")
+            name, arg = result.name, result.arg
+        if hasattr(self, "func_" + name) or not hasattr(self, "afunc_" + name):
+            value = super().call_function(name, arg)
+            if not inspect.isawaitable(value):
+                return value
+            if inspect.iscoroutine(value):
+                value.close()
+        raise RuntimeError(f"{name!r} is asynchronous, it can only be used from aeval()")
+
+    async def acall_user_function(self, name, args):
+        func = self.resolve_function(name)
+        frame = self.enter_function(func, args)
+        try:
+            value = await self._aeval(func['body'])
+        except Return as r:
+            return r.args[0]
+        finally:
+            self.leave_function(frame)
+        if self.pending is not None:
+            signal, self.pending = self.pending, None
+            if isinstance(signal, Return):
+                return signal.args[0]
+            raise signal
+        return value
+
+    async def ainput(self, prompt):
+        self.flush_output()
+        return await asyncio.to_thread(input, prompt)
+
+    async def _aoutputcmd(self, line, **kwargs):
+        if self.silenced:
+            # as in Engine._outputcmd
+            for node in self.interpolation(line):
+                for value in await self._aapply_ast_node(node):
+                    if type(value) not in _PLAIN_TEXT:
+                        str(value)
+            return
+        self.print(await self.ainterpolate(line), **kwargs)
+
+    async def afunc_say(self, line): await self._aoutputcmd(line)
+    async def afunc_puts(self, line): await self._aoutputcmd(line, end="")
+
+    async def afunc_set(self, line):
+        values = await self.aexpr(line)
+        val = None
+        while len(values) >= 2:
+            var = values[0]
+            val = values[1]
+            self.set(var, val)
+            values = values[2:]
+        if values:
+            val = self.get(values[0])
+        return val
+
+    async def afunc_silently(self, line):
+        self.silenced = True
+        try:
+            rv = await self.aeval(line)
+        finally:
+            self.silenced = False
+        return rv
+
+    async def afunc_list(self, line):
+        return list(await self.aexpr(line))
+
+    async def afunc_setsub(self, line):
+        container, key, val = await self.aexpr(line)
+        container[key] = val
+        return val
+
+    async def afunc_abort(self, line):
+        msg, = await self.aexpr(line)
+        raise Abort(msg)
+
+    async def afunc_return(self, line):
+        val, = await self.aexpr(line)
+        raise Return(val)
+
+    async def afunc_eval(self, line):
+        item, = await self.aexpr(line)
+        return await self.aeval(item)
+
+    async def afunc_dict(self, line):
+        return dict(await self.aexpr(line))
+
+    async def afunc_quote(self, line):
+        return await self.ainterpolate(line)
+
+    async def afunc_ask(self, line):
+        return await self.ainput(await self.ainterpolate(line) + " ")
+
+    async def afunc_confirm(self, line):
+        yes = ["y", "yes"]
+        no = ["n", "no"]
+        while True:
+            ans = (await self.ainput(await self.ainterpolate(line) + " (y/n) ")).lower()
+            if ans in yes:
+                return True
+            if ans in no:
+                return False
+
+    async def afunc_call(self, line):
+        func, *args = await self.aexpr(line)
+        return await self.acall_user_function(func, args)
+
+    async def afunc_take(self, line):
+        count, seq = await self.aexpr(line)
+        return LazySeq(lambda: itertools.islice(seq, count))
+
+    async def afunc_zip(self, line):
+        seqs = await self.aexpr(line)
+        return LazySeq(lambda: zip(*seqs))
+
+    async def ablock_if_then_else(self, block):
+        cond, = await self.aexpr(block['if'])
+        if cond:
+            return await self._aeval(block['then'])
+        return await self._aeval(block['else'])
+
+    async def ablock_while_do(self, block):
+        result = None
+        cond, = await self.aexpr(block['while'])
+        while cond:
+            try:
+                value = await self._aeval(block['do'])
+            except Next:
+                continue
+            except Done:
+                break
+            if (signal := self._take_loop_signal()) is not None:
+                if isinstance(signal, Next):
+                    continue
+                break
+            result = value
+            cond, = await self.aexpr(block['while'])
+        return result
+
+    async def ablock_foreach_in_do(self, block):
+        l, = await self.aexpr(block['in'])
+        result = None
+        for i in l:
+            self.set(block['foreach'], i)
+            try:
+                value = await self._aeval(block['do'])
+            except Next:
+                continue
+            except Done:
+                break
+            if (signal := self._take_loop_signal()) is not None:
+                if isinstance(signal, Next):
+                    continue
+                break
+            result = value
+        return result
+
+    async def ablock_template(self, block):
+        template = self.plan_template(block['template'])
+        out = template.new()
+        for path, code in template.holes:
+            out = template.put(out, path, await self.aeval(code))
+        return out
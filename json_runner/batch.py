@@ -0,0 +1,114 @@
+import itertools
+import sys
+
+from .string_parsing import Expression, FunctionCall
+
+# arithmetic, comparison and boolean operators; anything else applied to a
+# column sends the whole batch back to row-by-row evaluation
+VECTOR_PRECEDENCES = frozenset({400, 500, 600, 700, 900})
+_AND = frozenset({"and", "&&"})
+_OR = frozenset({"or", "||"})
+
+
+class _NotVectorizable(Exception):
+    pass
+
+
+class _Column:
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        self.values = values
+
+
+def _single(values):
+    value, = values
+    return value
+
+
+def _elementwise(op, text, left, right, length):
+    columns = [v.values for v in (left, right) if isinstance(v, _Column)]
+    a = left.values if isinstance(left, _Column) else left
+    b = right.values if isinstance(right, _Column) else right
+    # numpy is only ever used if the caller has already imported it and
+    # passed arrays in
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and all(isinstance(c, numpy.ndarray) for c in columns):
+        if text in _AND:
+            return numpy.where(a, b, a)
+        if text in _OR:
+            return numpy.where(a, a, b)
+        return _single(op(a, b))
+    if not isinstance(left, _Column):
+        a = itertools.repeat(a, length)
+    if not isinstance(right, _Column):
+        b = itertools.repeat(b, length)
+    return [_single(op(x, y)) for x, y in zip(a, b)]
+
+
+def _callbacks(engine, columns, length):
+    _, ops, groups, *_ = engine._get_op_state()
+    precedences = {text: p for p, texts in groups for text in texts}
+    callbacks = []
+    for text, op in ops.items():
+        if text == "$":
+            def callback(left, right, op=op):
+                if isinstance(right, str) and right in columns:
+                    return [left, _Column(columns[right])]
+                return op(left, right)
+        elif precedences[text] in VECTOR_PRECEDENCES:
+            def callback(left, right, op=op, text=text):
+                if isinstance(left, _Column) or isinstance(right, _Column):
+                    return [_Column(_elementwise(op, text, left, right, length))]
+                return op(left, right)
+        else:
+            def callback(left, right, op=op):
+                if isinstance(left, _Column) or isinstance(right, _Column):
+                    raise _NotVectorizable
+                return op(left, right)
+        callbacks.append(callback)
+    return tuple(callbacks)
+
+
+def _vector_expr(engine, tree, callbacks):
+    tokens = []
+    for node in tree.elements:
+        match node:
+            case Expression():
+                tokens.extend(_vector_expr(engine, node, callbacks))
+            case FunctionCall():
+                # might have side effects, so it has to run once per row
+                raise _NotVectorizable
+            case _:
+                tokens.append(node)
+    return engine._reduce_values(tokens, callbacks)
+
+
+def _rows(engine, tree, columns, length):
+    scope = engine.snapshot_scope()
+    row = engine.fork(scope)
+    names = list(columns)
+    out = []
+    for values in zip(*columns.values()):
+        scope.update(zip(names, values))
+        out.append(_single(row.expr(tree)))
+    return out
+
+
+def expr_batch(engine, tree, columns):
+    if isinstance(tree, str):
+        tree = engine.parse(tree, "expr")
+    lengths = {len(c) for c in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError("columns must all be the same length")
+    length = lengths.pop() if lengths else 0
+    if not length:
+        # no rows, so nothing to evaluate, as with calling expr() per row
+        return []
+    try:
+        value = _single(_vector_expr(engine, tree, _callbacks(engine, columns, length)))
+    except _NotVectorizable:
+        return _rows(engine, tree, columns, length)
+    if isinstance(value, _Column):
+        return value.values
+    return [value] * length
@@ -0,0 +1,112 @@
+class Compiled:
+    __slots__ = ("run", "source")
+
+    def __init__(self, run, source):
+        self.run = run
+        self.source = source
+
+    def __call__(self, engine):
+        return engine.eval(self)
+
+    def __repr__(self):
+        # shows up where the source would have, e.g. as the body of a
+        # function made by a compiled program
+        return repr(self.source)
+
+    def __reduce__(self):
+        # the closures can't be pickled, so a compiled program travels (to
+        # another process, say) as its source
+        return _source, (self.source,)
+
+
+def _source(source):
+    return source
+
+
+def _constant(value):
+    return lambda engine: value
+
+
+def _compile_str(engine, code, optimizer):
+    code = code.strip()
+    if not code:
+        return _constant(None)
+    call = engine.parse(code, "call")
+    name, arg = call.name, call.arg
+    signal = engine.signal_table().get(name)
+    if signal is not None:
+        if optimizer is not None:
+            arg = optimizer.signal_arg(signal, arg)
+        return lambda engine: engine._signal(signal, arg)
+    if hasattr(engine, "func_" + name):
+        attr, arg = "func_" + name, arg.strip()
+        if optimizer is not None:
+            arg = optimizer.function_arg(name, arg)
+        return lambda engine: getattr(engine, attr)(arg)
+    tree = engine.parse(arg, "expr")
+    if optimizer is not None:
+        tree = optimizer.expression(tree)
+    return lambda engine: engine.call_user_function(name, engine.expr(tree))
+
+
+def _compile_list(engine, code, optimizer):
+    items = tuple(compile_code(engine, item, optimizer) for item in code)
+
+    def run(engine):
+        engine.reset_result()
+        for item in items:
+            value = item.run(engine)
+            if engine.pending is not None:
+                return value
+            engine.set("result", value)
+        return engine.get("result")
+    return run
+
+
+def _compile_dict(engine, code, optimizer):
+    attr = engine.find_block(code)
+    if optimizer is not None:
+        optimizer = optimizer.block_scope(engine, code)
+    block = {}
+    for key, value in code.items():
+        if key in engine.code_keys:
+            value = compile_code(engine, value, optimizer)
+        elif key in engine.expr_keys and isinstance(value, str):
+            value = engine.parse(value, "expr")
+            if optimizer is not None:
+                value = optimizer.expression(value)
+        block[key] = value
+    if optimizer is not None:
+        # a block whose outcome is already known (an if with a constant
+        # condition, say) is replaced by what it would have run
+        known = optimizer.block(attr, block)
+        if known is not None:
+            return known.run
+    return lambda engine: getattr(engine, attr)(block)
+
+
+def _deferred(code):
+    # eval() only notices an unknown block or a line it can't parse when it
+    # gets to it, which it may never do; the error waits until then here too
+    return lambda engine: engine._eval(code)
+
+
+def compile_code(engine, code, optimizer=None):
+    match code:
+        case Compiled():
+            return code
+        case str():
+            try:
+                run = _compile_str(engine, code, optimizer)
+            except Exception:
+                run = _deferred(code)
+        case list() | tuple():
+            run = _compile_list(engine, code, optimizer)
+        case dict():
+            try:
+                run = _compile_dict(engine, code, optimizer)
+            except Exception:
+                run = _deferred(code)
+        case _:
+            run = _constant(code)
+    return Compiled(run, code)
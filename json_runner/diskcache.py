@@ -0,0 +1,148 @@
+import hashlib
+import json
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+
+from . import _install, _uninstall
+from .string_parsing import Expression, FunctionCall
+
+# magic, format version, reserved, blake2b-256 of the payload; the payload
+# is a marshalled list of (text, kind, tree) with the trees flattened into
+# tagged tuples
+MAGIC = b"JRPC"
+VERSION = 1
+_HEADER = struct.Struct("<4sHH32s")
+
+
+def _encode(tree):
+    match tree:
+        case Expression():
+            return ("e", tuple(map(_encode, tree.elements)))
+        case FunctionCall():
+            return ("c", tree.name, tree.arg)
+        case tuple():
+            return ("i", tuple(map(_encode, tree)))
+        case _:
+            return tree
+
+
+def _decode(tree):
+    if not isinstance(tree, tuple):
+        return tree
+    match tree[0]:
+        case "e":
+            return Expression(tuple(map(_decode, tree[1])))
+        case "c":
+            return FunctionCall(tree[1], tree[2])
+        case "i":
+            return tuple(map(_decode, tree[1]))
+        case tag:
+            raise ValueError(f"bad tree tag {tag!r}")
+
+
+def _checksum(payload):
+    return hashlib.blake2b(payload, digest_size=32).digest()
+
+
+def _read(data):
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, _, digest = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return None
+    with memoryview(data) as view, view[_HEADER.size:] as payload:
+        if _checksum(payload) != digest:
+            return None
+        return marshal.loads(payload)
+
+
+class DiskCache:
+    # the trees are the program's own, kept apart from the engine's
+    # parse_cache, which a program with more lines than it holds would
+    # push them out of
+    def __init__(self, directory):
+        self.directory = os.fspath(directory)
+        self.trees = {}
+        self.changed = False
+        self._engine = None
+        self._wrapped = self._saved = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def key(self, engine, code):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{VERSION} {marshal.version}\0".encode())
+        h.update("\0".join(sorted(engine.operator_atoms)).encode())
+        h.update(b"\0")
+        h.update(json.dumps(code, sort_keys=True, default=repr).encode())
+        return h.hexdigest()
+
+    def path(self, engine, code):
+        return os.path.join(self.directory, self.key(engine, code) + ".jrpc")
+
+    def load(self, engine, code):
+        try:
+            f = open(self.path(engine, code), "rb")
+        except FileNotFoundError:
+            return False
+        with f:
+            if not os.fstat(f.fileno()).st_size:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                entries = _read(data)
+        if entries is None:
+            return False
+        for text, kind, tree in entries:
+            self.trees.setdefault((text, kind), _decode(tree))
+        return True
+
+    def _wrap_parse(self, parse):
+        trees = self.trees
+
+        def wrapper(text, kind):
+            tree = trees.get((text, kind))
+            if tree is None:
+                tree = trees[text, kind] = parse(text, kind)
+                self.changed = True
+            return tree
+        return wrapper
+
+    def attach(self, engine):
+        # while attached, the engine's parse() gets its trees from here and
+        # adds the ones it has to make
+        if self._engine is not None:
+            raise RuntimeError("disk cache is already attached")
+        self._wrapped = {"parse": self._wrap_parse(engine.parse)}
+        self._saved = _install(engine, self._wrapped)
+        self._engine = engine
+        return self
+
+    def detach(self):
+        if self._engine is None:
+            return
+        _uninstall(self._engine, self._wrapped, self._saved)
+        self._engine = None
+        self._wrapped = self._saved = {}
+
+    def save(self, engine, code):
+        entries = [(text, kind, _encode(tree)) for (text, kind), tree in self.trees.items()]
+        payload = marshal.dumps(entries)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(_HEADER.pack(MAGIC, VERSION, 0, _checksum(payload)))
+                f.write(payload)
+            # readers only ever see a complete file
+            os.replace(temp, self.path(engine, code))
+        except BaseException:
+            os.unlink(temp)
+            raise
+        self.changed = False
@@ -0,0 +1,134 @@
+import inspect
+import sys
+import time
+import weakref
+
+from . import LimitExceeded, _install, _uninstall
+
+
+class Limits:
+    def __init__(self, steps=None, ops=None, depth=None, seconds=None, memory=None,
+                 clock=time.monotonic):
+        self.max_steps = steps
+        self.max_ops = ops
+        self.max_depth = depth
+        self.max_memory = memory
+        self.clock = clock
+        self.start = clock()
+        self.deadline = None if seconds is None else self.start + seconds
+        self.steps = 0
+        self.ops = 0
+        self.depth = 0
+        self.memory = 0
+        self._engines = weakref.WeakKeyDictionary()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def usage(self):
+        return {"steps": self.steps, "ops": self.ops, "depth": self.depth,
+                "seconds": self.clock() - self.start, "memory": self.memory}
+
+    def _exceeded(self, limit):
+        raise LimitExceeded(f"{limit} limit exceeded", limit, self.usage())
+
+    def step(self):
+        self.steps += 1
+        if self.max_steps is not None and self.steps > self.max_steps:
+            self._exceeded("steps")
+        # reading the clock costs more than everything else here put together
+        if self.deadline is not None and not self.steps & 63 and self.clock() > self.deadline:
+            self._exceeded("seconds")
+
+    def _allocated(self, value):
+        self.memory += sys.getsizeof(value)
+        if self.memory > self.max_memory:
+            self._exceeded("memory")
+
+    def _wrap_step(self, func, measure=True):
+        step = self.step
+        if not measure or self.max_memory is None or inspect.iscoroutinefunction(func):
+            def wrapper(*args):
+                step()
+                return func(*args)
+        else:
+            allocated = self._allocated
+
+            def wrapper(*args):
+                step()
+                value = func(*args)
+                allocated(value)
+                return value
+        return wrapper
+
+    def _wrap_op(self, func):
+        def wrapper(left, right):
+            self.ops += 1
+            if self.max_ops is not None and self.ops > self.max_ops:
+                self._exceeded("ops")
+            value = func(left, right)
+            if self.max_memory is not None and isinstance(value, list) and value:
+                # the new value is the last one; anything before it is the
+                # left operand, passed through by prefix operators
+                self._allocated(value[-1])
+            return value
+        return wrapper
+
+    def _wrap_depth(self, enter, leave):
+        # call depth is per engine, so that forks running side by side in
+        # threads don't add up
+        depth = [0]
+
+        def enter_function(func, args):
+            frame = enter(func, args)
+            depth[0] += 1
+            if depth[0] > self.depth:
+                self.depth = depth[0]
+            if self.max_depth is not None and depth[0] > self.max_depth:
+                leave(frame)
+                depth[0] -= 1
+                self._exceeded("depth")
+            return frame
+
+        def leave_function(frame):
+            depth[0] -= 1
+            leave(frame)
+        return enter_function, leave_function
+
+    def attach(self, engine):
+        if engine.limits is not None:
+            raise RuntimeError("engine already has limits")
+        wrapped = {}
+        for attr in dir(engine):
+            prefix, _, name = attr.partition("_")
+            if not name:
+                continue
+            if prefix in ("func", "block", "afunc", "ablock"):
+                wrapped[attr] = self._wrap_step(getattr(engine, attr))
+            elif prefix == "op":
+                wrapped[attr] = self._wrap_op(getattr(engine, attr))
+        # loop iterations (through _take_loop_signal, which the loop blocks
+        # call once per iteration) and done/next/return statements count
+        # as well, so that a loop that calls nothing still uses up steps
+        for attr in ("expr", "aexpr", "_signal", "_asignal", "_take_loop_signal"):
+            if hasattr(engine, attr):
+                wrapped[attr] = self._wrap_step(getattr(engine, attr), False)
+        wrapped["enter_function"], wrapped["leave_function"] = self._wrap_depth(
+            engine.enter_function, engine.leave_function)
+        # kept on the engine, since the wrappers refer to it and the
+        # engines here are only weakly held
+        engine._limits_installed = wrapped, _install(engine, wrapped)
+        engine.limits = self
+        self._engines[engine] = None
+        return self
+
+    def detach(self, engine=None):
+        for engine in [engine] if engine is not None else list(self._engines):
+            if engine not in self._engines:
+                continue
+            _uninstall(engine, *engine._limits_installed)
+            del self._engines[engine], engine._limits_installed
+            engine.limits = None
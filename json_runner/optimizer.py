@@ -0,0 +1,199 @@
+import copy
+import operator
+
+from . import Engine, Return
+from .compiler import Compiled, _constant
+from .string_parsing import Expression, FunctionCall
+
+# operators at these precedences only compute a value from their operands,
+# so applying them to constants can be done ahead of time
+FOLD_PRECEDENCES = frozenset({200, 300, 400, 500, 600, 700, 800, 801, 900, 1000, 1001})
+
+
+class Optimizer:
+    def __init__(self, engine, frozen=None):
+        self.engine = engine
+        self.frozen = dict(frozen or {})
+        _, _, groups, _, self.ranks, _ = engine._get_op_state()
+        self.foldable = frozenset(text for precedence, texts in groups
+                                  if precedence in FOLD_PRECEDENCES for text in texts)
+        # $name can only be replaced by its value if $ is applied before
+        # anything else, as it is in Engine
+        self.dollar = "$" if self.ranks.get("$") == min(self.ranks.values(), default=None) else None
+
+    def _is_op(self, token):
+        return isinstance(token, str) and token in self.ranks
+
+    def _is_constant(self, token):
+        return not isinstance(token, (Expression, FunctionCall)) and not self._is_op(token)
+
+    def expression(self, tree):
+        elements = []
+        for element in tree.elements:
+            if isinstance(element, Expression):
+                element = self.expression(element)
+                # a bracketed expression's values are spliced into the outer
+                # one when it runs, so once they're known they can be now
+                if all(map(self._is_constant, element.elements)):
+                    elements.extend(element.elements)
+                    continue
+            elements.append(element)
+        if self.frozen and self.dollar is not None:
+            elements = self._substitute(elements)
+        elements = self._fold(elements, None, None)
+        if len(elements) == len(tree.elements) and all(map(operator.is_, elements, tree.elements)):
+            return tree
+        return Expression(tuple(elements))
+
+    def _substitute(self, elements):
+        out = []
+        i = 0
+        while i < len(elements):
+            token = elements[i]
+            if (token == self.dollar and i + 1 < len(elements)
+                    and not (out and out[-1] == self.dollar)
+                    and isinstance(name := elements[i + 1], str) and not self._is_op(name)
+                    and name in self.frozen and not self._is_op(value := self.frozen[name])):
+                out.append(value)
+                i += 2
+                continue
+            out.append(token)
+            i += 1
+        return out
+
+    def _fold(self, tokens, left, right):
+        # tokens is a run between two operators ranked left and right (None
+        # for the ends of the expression). The constant stretches of it are
+        # worked out on their own when their operators would all be applied
+        # before the ones around them, which is what reducing the whole
+        # expression at run time would do first. This assumes variables and
+        # calls don't produce operator names.
+        out = []
+        start = 0
+        for i in range(len(tokens) + 1):
+            if i < len(tokens) and (self._is_constant(tokens[i]) or self._is_op(tokens[i]) and tokens[i] in self.foldable):
+                continue
+            out.extend(self._fold_run(tokens[start:i],
+                                      self._rank(tokens, start - 1, left),
+                                      self._rank(tokens, i, right)))
+            if i < len(tokens):
+                out.append(tokens[i])
+            start = i + 1
+        return out
+
+    def _rank(self, tokens, i, outside):
+        if i < 0 or i >= len(tokens):
+            return outside
+        return self.ranks.get(tokens[i]) if self._is_op(tokens[i]) else None
+
+    def _fold_run(self, run, left, right):
+        # trim operators off the ends, which belong to the neighbours
+        start, end = 0, len(run)
+        while start < end and self._is_op(run[start]):
+            start += 1
+        while end > start and self._is_op(run[end - 1]):
+            end -= 1
+        if start > 0:
+            left = self.ranks[run[start - 1]]
+        if end < len(run):
+            right = self.ranks[run[end]]
+        middle = run[start:end]
+        ranks = [self.ranks[t] for t in middle if self._is_op(t)]
+        if not ranks:
+            return run
+        top = max(ranks)
+        # equal operators are applied left to right
+        if (left is None or left > top) and (right is None or right >= top):
+            folded = self._reduce(middle)
+            if folded is not None:
+                return [*run[:start], *folded, *run[end:]]
+        # split at the operators applied last and try the pieces
+        out = list(run[:start])
+        piece = []
+        for token in middle:
+            if self._is_op(token) and self.ranks[token] == top:
+                out.extend(self._fold_run(piece, left, top))
+                out.append(token)
+                left, piece = top, []
+            else:
+                piece.append(token)
+        out.extend(self._fold_run(piece, left, right))
+        out.extend(run[end:])
+        return out
+
+    def _reduce(self, tokens):
+        try:
+            values = self.engine._reduce_values(list(tokens))
+        except Exception:
+            # leave it to fail when it runs, if it ever does
+            return None
+        # a list or dict worked out here would be the same object every time
+        # the expression runs, so changing one result would change the rest
+        if not all(map(self._is_constant, values)) or any(isinstance(v, (list, dict, set)) for v in values):
+            return None
+        return values
+
+    def interpolation(self, segments):
+        out = []
+        for segment in segments:
+            if isinstance(segment, Expression):
+                segment = self.expression(segment)
+                if all(map(self._is_constant, segment.elements)):
+                    segment = "".join(map(str, segment.elements))
+            if isinstance(segment, str) and out and isinstance(out[-1], str):
+                out[-1] += segment
+            else:
+                out.append(segment)
+        return tuple(out)
+
+    def _builtin(self, attr):
+        # only Engine's own handlers are known to take what's passed here;
+        # a subclass that overrides one gets its usual string
+        return getattr(type(self.engine), attr, None) is getattr(Engine, attr, None)
+
+    def signal_arg(self, signal, arg):
+        if signal is Return and self._builtin("_signal"):
+            return self.expression(self.engine.parse(arg, "expr"))
+        return arg
+
+    def function_arg(self, name, arg):
+        if name in self.engine.interpolate_functions and self._builtin("func_" + name):
+            return self.interpolation(self.engine.parse(arg, "interpolate"))
+        return arg
+
+    def block_scope(self, engine, block):
+        # names given in a block's other keys (a function's name and
+        # parameters, a loop variable) are set by it, so aren't frozen in it
+        names = set()
+        for key, value in block.items():
+            if key in engine.code_keys or key in engine.expr_keys:
+                continue
+            if isinstance(value, str):
+                names.add(value)
+            elif isinstance(value, (list, tuple)):
+                names.update(v for v in value if isinstance(v, str))
+        if not names & self.frozen.keys():
+            return self
+        optimizer = copy.copy(self)
+        optimizer.frozen = {k: v for k, v in self.frozen.items() if k not in names}
+        return optimizer
+
+    def _known(self, block, key):
+        tree = block[key]
+        if isinstance(tree, Expression) and len(tree.elements) == 1 and self._is_constant(tree.elements[0]):
+            return True, tree.elements[0]
+        return False, None
+
+    def block(self, attr, block):
+        if not self._builtin(attr):
+            return None
+        match attr:
+            case "block_if_then_else":
+                known, cond = self._known(block, "if")
+                if known:
+                    return block["then"] if cond else block["else"]
+            case "block_while_do":
+                known, cond = self._known(block, "while")
+                if known and not cond:
+                    return Compiled(_constant(None), None)
+        return None
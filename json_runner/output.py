@@ -0,0 +1,47 @@
+import sys
+import threading
+
+
+class BufferedOutput:
+    def __init__(self, target=None, buffer_size=65536, line_buffered=False):
+        # target is a file, a function that takes a string, or None for
+        # whatever sys.stdout is when the buffer is flushed
+        self.target = target
+        self.buffer_size = buffer_size
+        self.line_buffered = line_buffered
+        self._parts = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def write(self, text):
+        with self._lock:
+            self._parts.append(text)
+            self._size += len(text)
+            if self._size < self.buffer_size and not (self.line_buffered and "\n" in text):
+                return
+            text = "".join(self._parts)
+            self._parts.clear()
+            self._size = 0
+            self._send(text)
+
+    def flush(self):
+        with self._lock:
+            text = "".join(self._parts)
+            self._parts.clear()
+            self._size = 0
+            if text:
+                self._send(text)
+
+    def _send(self, text):
+        target = sys.stdout if self.target is None else self.target
+        write = getattr(target, "write", target)
+        write(text)
+        flush = getattr(target, "flush", None)
+        if flush is not None:
+            flush()
@@ -0,0 +1,130 @@
+import time
+from collections import Counter
+
+from . import _install, _op_spec, _uninstall
+
+
+class Profiler:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.stats = {}
+        self.stacks = Counter()
+        self._stack = []
+        self._active = Counter()
+        self._engine = None
+        self._wrapped = {}
+        self._saved = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def _enter(self, label):
+        self._stack.append([label, self.clock(), 0.0])
+        self._active[label] += 1
+
+    def _leave(self):
+        label, start, children = self._stack.pop()
+        elapsed = self.clock() - start
+        self._active[label] -= 1
+        calls, total, own = self.stats.get(label, (0, 0.0, 0.0))
+        # recursive calls only count towards the total of the outermost one
+        if not self._active[label]:
+            total += elapsed
+        self.stats[label] = (calls + 1, total, own + elapsed - children)
+        path = ";".join([f[0] for f in self._stack] + [label])
+        self.stacks[path] += elapsed - children
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def _wrap(self, label, func):
+        def wrapper(*args):
+            self._enter(label)
+            try:
+                return func(*args)
+            finally:
+                self._leave()
+        return wrapper
+
+    def _wrap_calls(self, resolve, enter, leave):
+        # user functions are timed from enter_function to leave_function,
+        # which both call_user_function and the VM go through; enter_function
+        # only gets the function, so the name is the one resolve_function
+        # was asked for just before
+        name = ["<lambda>"]
+
+        def resolve_function(func):
+            name[0] = func if isinstance(func, str) else "<lambda>"
+            return resolve(func)
+
+        def enter_function(func, args):
+            frame = enter(func, args)
+            self._enter("call " + name[0])
+            return frame
+
+        def leave_function(frame):
+            self._leave()
+            leave(frame)
+        return resolve_function, enter_function, leave_function
+
+    def attach(self, engine):
+        if self._engine is not None:
+            raise RuntimeError("profiler is already attached")
+        wrapped = {}
+        for attr in dir(engine):
+            prefix, _, name = attr.partition("_")
+            if prefix == "func" and name:
+                label = "func " + name
+            elif prefix == "block" and name:
+                label = "block " + name
+            elif prefix == "op" and name:
+                label = "op " + _op_spec(attr)[1]
+            else:
+                continue
+            wrapped[attr] = self._wrap(label, getattr(engine, attr))
+        wrappers = self._wrap_calls(engine.resolve_function, engine.enter_function,
+                                    engine.leave_function)
+        wrapped.update(zip(("resolve_function", "enter_function", "leave_function"), wrappers))
+        wrapped["parse"] = self._wrap("parse", engine.parse)
+        wrapped["eval"] = self._wrap("eval", engine.eval)
+        self._saved = _install(engine, wrapped)
+        self._wrapped = wrapped
+        self._engine = engine
+        return self
+
+    def detach(self):
+        if self._engine is None:
+            return
+        _uninstall(self._engine, self._wrapped, self._saved)
+        self._engine = None
+        self._wrapped = self._saved = {}
+
+    def clear(self):
+        self.stats.clear()
+        self.stacks.clear()
+
+    def summary(self):
+        parse = sum(own for label, (_, _, own) in self.stats.items() if label == "parse")
+        total = sum(own for _, _, own in self.stats.values())
+        return {"parse": parse, "eval": total - parse}
+
+    def report(self, limit=None):
+        rows = sorted(self.stats.items(), key=lambda item: item[1][2], reverse=True)
+        lines = [f"{'calls':>10} {'total s':>10} {'own s':>10}  name"]
+        for label, (calls, total, own) in rows[:limit]:
+            lines.append(f"{calls:10d} {total:10.6f} {own:10.6f}  {label}")
+        summary = self.summary()
+        lines.append(f"parse {summary['parse']:.6f}s, eval {summary['eval']:.6f}s")
+        return "\n".join(lines)
+
+    def collapsed(self):
+        # one "frame;frame;frame microseconds" line per stack, which is the
+        # input format of flamegraph.pl and speedscope
+        return "\n".join(f"{path} {round(own * 1e6)}"
+                         for path, own in sorted(self.stacks.items()))
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            f.write(self.collapsed() + "\n")
@@ -0,0 +1,105 @@
+import codecs
+import json
+import os
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+_NUMBER = "0123456789+-.eE"
+
+
+class _Reader:
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self._decode = None
+
+    def fill(self):
+        chunk = self.fp.read(self.chunk_size)
+        if isinstance(chunk, bytes):
+            if self._decode is None:
+                self._decode = codecs.getincrementaldecoder("utf-8-sig")().decode
+            chunk = self._decode(chunk, final=not chunk)
+        if not chunk:
+            self.eof = True
+            return False
+        # drop what has already been consumed so memory stays bounded by
+        # the largest single statement
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.fill():
+                return
+
+    def peek(self):
+        self.skip_whitespace()
+        return self.buf[self.pos] if self.pos < len(self.buf) else ""
+
+    def value(self):
+        while True:
+            self.skip_whitespace()
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # a number could continue in the next chunk, and raw_decode
+            # stops at whatever of it is valid so far ("12." gives 12)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                rest = end
+                while rest < len(self.buf) and self.buf[rest] in _NUMBER:
+                    rest += 1
+                if rest == len(self.buf) and not self.eof and self.fill():
+                    continue
+            self.pos = end
+            return value
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars or not char:
+            raise json.JSONDecodeError(f"expected one of {chars!r}", self.buf, self.pos)
+        self.pos += 1
+        return char
+
+
+def _iter_array(reader):
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(",]") == "]":
+            return
+
+
+def _iter_lines(reader):
+    while reader.peek():
+        yield reader.value()
+
+
+def iter_statements(fp, format="auto", chunk_size=65536):
+    if isinstance(fp, (str, os.PathLike)):
+        with open(fp, encoding="utf-8") as f:
+            yield from iter_statements(f, format, chunk_size)
+        return
+    reader = _Reader(fp, chunk_size)
+    if format == "auto":
+        format = "json" if reader.peek() == "[" else "ndjson"
+    match format:
+        case "json":
+            yield from _iter_array(reader)
+            if reader.peek():
+                raise json.JSONDecodeError("extra data", reader.buf, reader.pos)
+        case "ndjson":
+            yield from _iter_lines(reader)
+        case _:
+            raise ValueError(f"unknown stream format {format!r}")
@@ -1,32 +1,90 @@
 
 
-from dataclasses import dataclass, field
-from typing import Any
-import regex
+import re
+import threading
+from collections import OrderedDict
+
+
+_UNSET = object()
 
 
-@dataclass
 class Token:
-    start: int = field(compare=False)
-    value: Any
-    source: str = field(compare=False)
-    line: str = field(repr=False, compare=False)
+    # just the offsets into the line; the text and the value are only made
+    # when they're asked for
+    __slots__ = ("start", "end", "line", "_value")
+
+    def __init__(self, start, end, line, value=_UNSET):
+        self.start = start
+        self.end = end
+        self.line = line
+        self._value = value
+
+    @property
+    def source(self):
+        return self.line[self.start:self.end]
+
+    @property
+    def value(self):
+        value = self._value
+        if value is _UNSET:
+            value = self._value = process_token(self.line[self.start:self.end])
+        return value
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.value == other.value
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(start={self.start!r}, value={self.value!r}, source={self.source!r})"
+
+
+class _Node:
+    # a small frozen record; importing dataclasses would cost more than the
+    # rest of the package put together
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values, strict=True):
+            object.__setattr__(self, name, value)
 
+    def __setattr__(self, name, value):
+        raise AttributeError(f"cannot assign to field {name!r}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"cannot delete field {name!r}")
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{self.__class__.__name__}({fields})"
 
-@dataclass
-class Expression:
-    elements: list[Any]
+    def __reduce__(self):
+        return self.__class__, self._values()
 
 
-@dataclass
-class FunctionCall:
-    name: str
-    arg: str
+class Expression(_Node):
+    __slots__ = __match_args__ = ("elements",)
 
 
-class ParenList(list, Token):
-    opener: Token | None
-    closer: Token | None
+class FunctionCall(_Node):
+    __slots__ = __match_args__ = ("name", "arg")
+
+
+class ParenList(list):
+    __slots__ = ("opener", "closer")
 
     def __init__(self, *args):
         super().__init__(*args)
@@ -48,7 +106,7 @@ def raise_token_error(tokens, errormsg):
 
 
 def tokenslice(from_, to):
-    return from_.line[from_.start:to.start+len(to.source)]
+    return from_.line[from_.start:to.end]
 
 
 def get_end_token(it, which):
@@ -65,49 +123,68 @@ def _parse_secondpass(tree):
     treeval = None
     match tree.opener.value:
         case "{":
-            treeval = tokenslice(tree.opener, tree.closer)[
-                1:-1] if tree else ""
+            treeval = tree.opener.line[tree.opener.start + 1:tree.closer.end - 1] if tree else ""
         case "[":
             if tree:
                 treeval = FunctionCall(tree[0].source, tokenslice(get_end_token(
                     tree[1], False), get_end_token(tree[-1], True)) if len(tree) > 1 else "")
         case "(" | _:
-            treeval = Expression(list(map(_parse_secondpass, tree)))
+            treeval = Expression(tuple(map(_parse_secondpass, tree)))
     return treeval
 
 
+def _text_between(line, start, end):
+    # the text from one group's ")" to the next one's "(", without either
+    if start < end and line[end - 1] == "(":
+        end -= 1
+    if start < end and line[start] == ")":
+        start += 1
+    return line[start:end]
+
+
 def _interpolate_secondpass(top):
     out = []
+    line = top.opener.line
     prev = top.opener
     for item in top:
         if isinstance(item, ParenList) and item.opener.value == "(" and item.closer.value == ")":
-            if string := tokenslice(prev, item.opener).removesuffix("(").removeprefix(")"):
+            if string := _text_between(line, prev.start, item.opener.end):
                 out.append(string)
             out.append(_parse_secondpass(item))
             prev = item.closer
-    if string := tokenslice(prev, top.closer).removesuffix("(").removeprefix(")"):
+    if string := _text_between(line, prev.start, top.closer.end):
         out.append(string)
     return out
 
 
 def _parse_firstpass(line, atoms, wrapped, mismatch_pred=lambda _: True, notclosed_pred=lambda _: True):
+    return _nest(line, tokenize(line, atoms), wrapped, mismatch_pred, notclosed_pred)
+
+
+def _nest(line, tokens, wrapped, mismatch_pred=lambda _: True, notclosed_pred=lambda _: True):
     # first pass: nesting stuff
     stack = []
     current_tokens = ParenList()
     # everything is wrapped in top level function call
-    current_tokens.opener = Token(0, wrapped[0], wrapped[0], line)
+    current_tokens.opener = Token(0, 1, line, wrapped[0])
     c2o = dict(zip(")]}", "([{"))
-    for token in tokenize(line, atoms):
-        if token.value in c2o.values():
-            stack.append((current_tokens, token.value, token))
+    for token in tokens:
+        # only a single character or a quoted string can have a paren as its
+        # value, so the rest never need their value worked out here
+        if token.end - token.start == 1 or line[token.start] in "'\"":
+            value = token.value
+        else:
+            value = None
+        if value in c2o.values():
+            stack.append((current_tokens, value, token))
             current_tokens = ParenList()
             current_tokens.opener = token
-        elif token.value in c2o.keys():
-            closed_open = c2o[token.value]
+        elif value in c2o.keys():
+            closed_open = c2o[value]
             previous, expected_open, open_token = stack.pop()
             if expected_open != closed_open and mismatch_pred(stack):
                 raise_token_error(
-                    [token, open_token], f"mismatched parens: {expected_open} <-> {token.value}")
+                    [token, open_token], f"mismatched parens: {expected_open} <-> {value}")
             previous.append(current_tokens)
             current_tokens.closer = token
             current_tokens = previous
@@ -118,7 +195,7 @@ def _parse_firstpass(line, atoms, wrapped, mismatch_pred=lambda _: True, notclos
                           "these parens were never closed:")
     elif stack:
         current_tokens = stack[0][0]
-    current_tokens.closer = Token(len(line) - 1, wrapped[1], wrapped[1], line)
+    current_tokens.closer = Token(len(line) - 1, len(line), line, wrapped[1])
     return current_tokens
 
 
@@ -126,14 +203,16 @@ def parse2(line, atoms, wrapped):
     return _parse_secondpass(_parse_firstpass(line, atoms, wrapped))
 
 
+def _has_open(stack): return stack and stack[0][0].opener == "("
+
+
 def parse_interpolated(line, atoms):
-    def has_open(stack): return stack and stack[0][0].opener == "("
-    return _interpolate_secondpass(_parse_firstpass(line, atoms, "()", has_open, has_open))
+    return _interpolate_secondpass(_parse_firstpass(line, atoms, "()", _has_open, _has_open))
 
 
 def process_escapes(string):
     ESCAPES = dict(zip("nteoc", "\n\t\x1b{}"))
-    return regex.sub(r"\\(.)", lambda match: ESCAPES.get(match.group(1), match.group(1)), string)
+    return re.sub(r"\\(.)", lambda match: ESCAPES.get(match.group(1), match.group(1)), string)
 
 
 def process_token(token):
@@ -152,42 +231,209 @@ def process_token(token):
 
 def escape_atom(a):
     if a[0].isalpha() and a[-1].isalpha():
-        return fr"(?:\b{regex.escape(a)}\b)"
-    return f"(?:{regex.escape(a)})"
-
-
-def tokenize(string, atoms):
-    ATOM_REGEX = "|".join(
-        fr"(?&start){regex.escape(a)}(?&end)"
-        if a[0].isalpha() and a[-1].isalpha()
-        else regex.escape(a)
-        for a in sorted(atoms, key=len, reverse=True)
-    )
-    if ATOM_REGEX:
-        ATOM_REGEX = "| (?:%s)" % ATOM_REGEX
-    ALL_TOKENS = r"""
-    (?(DEFINE)
-        (?P<start>(?<=\s|^))
-        (?P<end>(?=\s|$))
-    )
-    (?P<special>
-          (?:[\[\](){}]) # parens
-        | (?:(?&start)(?P<q>['"])(?:\\\S|(?!(?P=q))[\s\S])*?(?P=q)(?&end))
-        # double or single quoted string
-        %s # an atom (but NOT in a word) -- this will be formatted in below     vv
-        | (?:0x\d+|-?\d+(?:\.\d+(?:[eE][+-]\d+)?)?) # a number
-    ) | (?:(?:(?!(?&special))\S)+) # anything that is not special token""" % ATOM_REGEX
-    ALL_TOKENS = regex.compile(ALL_TOKENS, flags=regex.X)
-    i = 0
-    while i < len(string):
-        match = ALL_TOKENS.search(string, i)
-        if not match:
-            return
-        token = match.group(0)
-        if not token:
-            raise_token_error([Token(i, None, " ", string)], f"empty token (internal error) {atoms=}")
-        yield Token(match.start(), process_token(token), token, string)
-        i = match.end()
+        return fr"(?:\b{re.escape(a)}\b)"
+    return f"(?:{re.escape(a)})"
+
+
+class LRUCache:
+    # safe to share between threads, so engines forked from one another can
+    # share their caches
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return value
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._data), "maxsize": self.maxsize}
+
+
+# the part of a token pattern that matches parens, quoted strings, atoms
+# and numbers; anything else up to the next one of those is a word
+_SPECIAL = r"""
+              (?:[\[\](){}]) # parens
+            | (?:%(start)s(?P<%(q)s>['"])(?:\\\S|(?!(?P=%(q)s))[\s\S])*?(?P=%(q)s)%(end)s)
+            # double or single quoted string
+            %(atoms)s # an atom (but NOT in a word)
+            | (?:0x\d+|-?\d+(?:\.\d+(?:[eE][+-]\d+)?)?) # a number
+"""
+
+
+class Tokenizer:
+    # the regex module lets the pattern name its lookarounds and call the
+    # whole special group from the word branch; plain re (the default, and
+    # much faster) gets the same thing spelled out, which matches exactly
+    # the same tokens
+    def __init__(self, atoms, backend="re"):
+        self.atoms = frozenset(atoms)
+        self.backend = backend
+        self.max_atom_words = max([1, *(len(a.split()) for a in self.atoms)])
+        match backend:
+            case "re":
+                module, start, end = re, r"(?<!\S)", r"(?!\S)"
+            case "regex":
+                import regex as module
+                start, end = r"(?&start)", r"(?&end)"
+            case _:
+                raise ValueError(f"unknown tokenizer backend {backend!r}")
+        self.atom_regex = "|".join(
+            f"{start}{module.escape(a)}{end}"
+            if a[0].isalpha() and a[-1].isalpha()
+            else module.escape(a)
+            for a in sorted(self.atoms, key=lambda a: (-len(a), a))
+        )
+        ATOM_REGEX = self.atom_regex
+        if ATOM_REGEX:
+            ATOM_REGEX = "| (?:%s)" % ATOM_REGEX
+
+        def special(q):
+            return _SPECIAL % {"start": start, "end": end, "q": q, "atoms": ATOM_REGEX}
+        if backend == "regex":
+            ALL_TOKENS = r"""
+        (?(DEFINE)
+            (?P<start>(?<=\s|^))
+            (?P<end>(?=\s|$))
+        )
+        (?P<special>%s) | (?:(?:(?!(?&special))\S)+) # anything that is not special token""" % special("q")
+        else:
+            ALL_TOKENS = r"""
+        (?P<special>%s) | (?:(?:(?!%s)\S)+) # anything that is not special token""" % (special("q"), special("q2"))
+        self.pattern = module.compile(ALL_TOKENS, flags=module.X)
+
+    def tokenize(self, string, i=0):
+        ALL_TOKENS = self.pattern
+        while i < len(string):
+            match = ALL_TOKENS.search(string, i)
+            if not match:
+                return
+            start, end = match.span()
+            if start == end:
+                atoms = self.atoms
+                raise_token_error([Token(i, i + 1, string, None)], f"empty token (internal error) {atoms=}")
+            yield Token(start, end, string)
+            i = end
+
+
+tokenizer_cache = LRUCache(32)
+
+
+def get_tokenizer(atoms, backend="re"):
+    atoms = atoms if isinstance(atoms, frozenset) else frozenset(atoms)
+    tokenizer = tokenizer_cache.get((atoms, backend))
+    if tokenizer is None:
+        tokenizer = tokenizer_cache.put((atoms, backend), Tokenizer(atoms, backend))
+    return tokenizer
+
+
+def tokenize(string, atoms, backend="re"):
+    return get_tokenizer(atoms, backend).tokenize(string)
+
+
+class IncrementalParser:
+    # keeps the tokens of a line so that after an edit only the edited
+    # stretch is lexed again, until the new tokens line up with the old ones
+    def __init__(self, line, atoms, kind="interpolate"):
+        self.tokenizer = get_tokenizer(atoms)
+        self.kind = kind
+        self.line = line
+        self.tokens = list(self.tokenizer.tokenize(line))
+
+    def edit(self, start, end, text):
+        line, tokens = self.line, self.tokens
+        new_line = line[:start] + text + line[end:]
+        delta = len(text) - (end - start)
+        edited_end = start + len(text)
+        # a token can be changed by an edit anywhere in the same run of
+        # non-space characters (numbers and words extend into what follows
+        # them), and a quote that isn't closed yet (or was closed only after
+        # backing off from an escape) can be closed by an edit anywhere
+        # after it
+        # (or several runs, if an operator has spaces in it)
+        run = start
+        for words in range(self.tokenizer.max_atom_words):
+            while words and run > 0 and line[run - 1].isspace():
+                run -= 1
+            while run > 0 and not line[run - 1].isspace():
+                run -= 1
+        first = 0
+        while first < len(tokens) and tokens[first].end < run:
+            first += 1
+        for i, token in enumerate(tokens[:first]):
+            source = token.source
+            if source[0] in "'\"" and (len(source) < 2 or source[-1] != source[0] or "\\" in source):
+                first = i
+                break
+        pos = min(run, tokens[first].start) if first < len(tokens) else run
+        old = first
+        new = []
+        for token in self.tokenizer.tokenize(new_line, pos):
+            if token.start >= edited_end:
+                while old < len(tokens) and tokens[old].start + delta < token.start:
+                    old += 1
+                # same place, same text and the same character before it:
+                # everything from here on lexes the same as before
+                if (old < len(tokens) and tokens[old].start + delta == token.start
+                        and tokens[old].source == token.source
+                        and new_line[token.start - 1:token.start] == line[tokens[old].start - 1:tokens[old].start]):
+                    break
+            new.append(token)
+        else:
+            old = len(tokens)
+        for token in tokens[old:]:
+            token.start += delta
+            token.end += delta
+        self.tokens = tokens = tokens[:first] + new + tokens[old:]
+        for token in tokens:
+            token.line = new_line
+        self.line = new_line
+        return self.result()
+
+    def result(self):
+        match self.kind:
+            case "interpolate":
+                return _interpolate_secondpass(_nest(self.line, self.tokens, "()", _has_open, _has_open))
+            case "expr":
+                return _parse_secondpass(_nest(self.line, self.tokens, "()"))
+            case "call":
+                return _parse_secondpass(_nest(self.line, self.tokens, "[]"))
+            case _:
+                raise ValueError(f"unknown parse kind {self.kind!r}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+import marshal
+
+_PLAIN = (str, int, float, bool, type(None))
+
+
+def _plan(val, depth, path, holes, plain):
+    match val:
+        case list() | tuple():
+            return [_plan(v, depth, path + (i,), holes, plain) for i, v in enumerate(val)]
+        case dict():
+            if len(val) == 1:
+                key, = val
+                if key == "template":
+                    depth += 1
+                elif key == "insert":
+                    depth -= 1
+                if depth == 0:
+                    holes.append((path, val[key]))
+                    return None
+            return {k: _plan(v, depth, path + (k,), holes, plain) for k, v in val.items()}
+        case _:
+            if not isinstance(val, _PLAIN):
+                plain[0] = False
+            return val
+
+
+def _copy(val):
+    match val:
+        case list():
+            return [_copy(v) for v in val]
+        case dict():
+            return {k: _copy(v) for k, v in val.items()}
+        case _:
+            return val
+
+
+class Template:
+    __slots__ = ("skeleton", "holes", "frozen", "snapshot")
+
+    def __init__(self, template):
+        # everything that doesn't depend on the code in the {"insert": ...}
+        # holes is worked out once here, so expanding the template only has
+        # to copy it and evaluate the holes
+        holes = []
+        plain = [True]
+        self.skeleton = _plan(template, 1, (), holes, plain)
+        self.holes = tuple(holes)
+        self.frozen = marshal.dumps(self.skeleton) if plain[0] else None
+        self.snapshot = self._snapshot(template)
+
+    @staticmethod
+    def _snapshot(template):
+        try:
+            # version 2 leaves out back-references, which depend on refcounts
+            return marshal.dumps(template, 2)
+        except ValueError:
+            return None
+
+    def matches(self, template):
+        # the template is a value like any other, so a program can change
+        # it between runs; a plan is only good for what it was made from
+        return self.snapshot is not None and self._snapshot(template) == self.snapshot
+
+    def new(self):
+        # a fresh copy of the static parts, so that the result can be changed
+        # without changing the next one; marshal does that in one C call
+        if self.frozen is not None:
+            return marshal.loads(self.frozen)
+        return _copy(self.skeleton)
+
+    @staticmethod
+    def put(out, path, value):
+        if not path:
+            return value
+        target = out
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = value
+        return out
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {len(self.holes)} holes>"
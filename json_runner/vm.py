@@ -0,0 +1,350 @@
+from array import array
+
+from . import BareEngine, Done, Engine, Next, Return
+from .compiler import Compiled
+from .string_parsing import LRUCache
+
+(CONST, CALL, CALL_USER, BLOCK, EXPR1, JUMP, JUMP_IF_FALSE, RESULT_NONE,
+ STORE_RESULT, LOAD_RESULT, STORE_LOOP, GET_ITER, FOR_ITER, UNWIND,
+ RETURN) = range(15)
+
+
+class Bytecode:
+    __slots__ = ("ops", "args", "loops", "source")
+
+    def __init__(self, source):
+        self.ops = array("B")
+        self.args = []
+        self.loops = []
+        self.source = source
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {len(self)} instructions {self.source!r}>"
+
+
+class _Loop:
+    __slots__ = ("start", "end", "next_depth", "next_target", "done_depth", "done_target")
+
+
+class _Assembler:
+    def __init__(self, engine, source):
+        self.engine = engine
+        self.code = Bytecode(source)
+        self.depth = 0
+        self.loops = []
+
+    def emit(self, op, arg=None, effect=0):
+        self.code.ops.append(op)
+        self.code.args.append(arg)
+        self.depth += effect
+        return len(self.code.ops) - 1
+
+    def patch(self, at, arg):
+        self.code.args[at] = arg
+
+    @property
+    def here(self):
+        return len(self.code.ops)
+
+    def assemble(self, code):
+        self.lower(code)
+        self.code.loops = tuple(self.code.loops)
+        return self.code
+
+    def lower(self, code):
+        if not isinstance(code, (str, dict)):
+            return self.lower_code(code)
+        start, depth = self.here, self.depth
+        loops, active = len(self.code.loops), len(self.loops)
+        try:
+            self.lower_code(code)
+        except Exception:
+            # an unknown block or a line that can't be parsed is only an
+            # error when the program gets to it, as it is for Engine
+            del self.code.ops[start:], self.code.args[start:]
+            del self.code.loops[loops:], self.loops[active:]
+            self.depth = depth
+            self.emit(CALL, ("eval_uncompiled", code), effect=1)
+
+    def lower_code(self, code):
+        match code:
+            case str():
+                self.lower_str(code.strip())
+            case list() | tuple():
+                self.emit(RESULT_NONE)
+                for item in code:
+                    self.lower(item)
+                    self.emit(STORE_RESULT, effect=-1)
+                self.emit(LOAD_RESULT, effect=1)
+            case dict():
+                attr = self.engine.find_block(code)
+                lower = getattr(self, "lower_" + attr, None)
+                if lower is not None:
+                    lower(code)
+                else:
+                    self.emit(BLOCK, (attr, code), effect=1)
+            case Compiled():
+                self.emit(CALL, ("eval", code), effect=1)
+            case _:
+                self.emit(CONST, code, effect=1)
+
+    def lower_str(self, code):
+        engine = self.engine
+        if not code:
+            self.emit(CONST, None, effect=1)
+            return
+        call = engine.parse(code, "call")
+        name, arg = call.name, call.arg
+        signal = engine.signal_table().get(name)
+        if signal in (Done, Next) and self.loops:
+            loop = self.loops[-1]
+            self.emit(UNWIND, (loop, name), effect=1)
+        elif signal is Return:
+            self.emit(EXPR1, engine.parse(arg, "expr"), effect=1)
+            self.emit(RETURN, effect=0)
+        elif hasattr(engine, "func_" + name):
+            self.emit(CALL, ("func_" + name, arg.strip()), effect=1)
+        else:
+            self.emit(CALL_USER, (name, engine.parse(arg, "expr")), effect=1)
+
+    def expression(self, code):
+        return code if not isinstance(code, str) else self.engine.parse(code, "expr")
+
+    def lower_block_if_then_else(self, block):
+        self.emit(EXPR1, self.expression(block['if']), effect=1)
+        to_else = self.emit(JUMP_IF_FALSE, effect=-1)
+        self.lower(block['then'])
+        to_end = self.emit(JUMP, effect=-1)
+        self.patch(to_else, self.here)
+        self.lower(block['else'])
+        self.patch(to_end, self.here)
+
+    def loop_body(self, loop, body):
+        self.loops.append(loop)
+        self.code.loops.append(loop)
+        loop.start = self.here
+        self.lower(body)
+        loop.end = self.here
+        self.loops.pop()
+
+    def lower_block_while_do(self, block):
+        # the loop's result lives in a stack slot under everything else
+        self.emit(CONST, None, effect=1)
+        loop = _Loop()
+        loop.next_depth = loop.done_depth = self.depth
+        self.emit(EXPR1, self.expression(block['while']), effect=1)
+        top = self.emit(JUMP_IF_FALSE, effect=-1)
+        # a "next" goes straight back into the body without re-testing the
+        # condition, just like the tree-walking Engine
+        loop.next_target = self.here
+        self.loop_body(loop, block['do'])
+        self.emit(STORE_LOOP, loop.done_depth - 1, effect=-1)
+        self.emit(EXPR1, self.expression(block['while']), effect=1)
+        self.emit(JUMP, top, effect=-1)
+        loop.done_target = self.here
+        self.patch(top, self.here)
+
+    def lower_block_foreach_in_do(self, block):
+        self.emit(CONST, None, effect=1)
+        loop = _Loop()
+        loop.done_depth = self.depth
+        self.emit(EXPR1, self.expression(block['in']), effect=1)
+        self.emit(GET_ITER)
+        loop.next_depth = self.depth
+        loop.next_target = top = self.emit(FOR_ITER, [block['foreach'], None])
+        self.loop_body(loop, block['do'])
+        self.emit(STORE_LOOP, loop.done_depth - 1, effect=-1)
+        self.emit(JUMP, top)
+        self.depth -= 1
+        loop.done_target = self.here
+        self.code.args[top][1] = self.here
+
+
+def assemble(engine, code):
+    return _Assembler(engine, code).assemble(code)
+
+
+def _find_loop(code, pc):
+    for loop in reversed(code.loops):
+        if loop.start <= pc < loop.end:
+            return loop
+    return None
+
+
+def execute(engine, code, function=False):
+    stack = []
+    frames = []
+    base = pc = 0
+    ops, args = code.ops, code.args
+    # loops that only jump around call nothing that Limits counts
+    limits = engine.limits
+    try:
+        while True:
+            try:
+                while True:
+                    if pc >= len(ops):
+                        value = stack.pop()
+                        if not frames:
+                            return value
+                        code, pc, base, frame = frames.pop()
+                        ops, args = code.ops, code.args
+                        engine.leave_function(frame)
+                        stack.append(value)
+                        continue
+                    op = ops[pc]
+                    arg = args[pc]
+                    pc += 1
+                    if op == EXPR1:
+                        value, = engine.expr(arg)
+                        stack.append(value)
+                    elif op == JUMP_IF_FALSE:
+                        if not stack.pop():
+                            pc = arg
+                    elif op == JUMP:
+                        pc = arg
+                    elif op == CALL:
+                        attr, line = arg
+                        stack.append(getattr(engine, attr)(line))
+                    elif op == STORE_RESULT:
+                        engine.set("result", stack.pop())
+                    elif op == RESULT_NONE:
+                        engine.reset_result()
+                    elif op == LOAD_RESULT:
+                        stack.append(engine.get("result"))
+                    elif op == CALL_USER:
+                        name, tree = arg
+                        fargs = engine.expr(tree)
+                        func = engine.resolve_function(name)
+                        frames.append((code, pc, base, engine.enter_function(func, fargs)))
+                        code = engine.assemble(func['body'])
+                        ops, args = code.ops, code.args
+                        base, pc = len(stack), 0
+                    elif op == FOR_ITER:
+                        if limits is not None:
+                            limits.step()
+                        var, end = arg
+                        try:
+                            item = next(stack[-1])
+                        except StopIteration:
+                            stack.pop()
+                            pc = end
+                        else:
+                            engine.set(var, item)
+                    elif op == STORE_LOOP:
+                        stack[base + arg] = stack.pop()
+                    elif op == GET_ITER:
+                        stack[-1] = iter(stack[-1])
+                    elif op == UNWIND:
+                        if limits is not None:
+                            limits.step()
+                        loop, which = arg
+                        if which == "next":
+                            del stack[base + loop.next_depth:]
+                            pc = loop.next_target
+                        else:
+                            del stack[base + loop.done_depth:]
+                            pc = loop.done_target
+                    elif op == RETURN:
+                        value = stack.pop()
+                        if not frames:
+                            if function:
+                                return value
+                            raise Return(value)
+                        code, pc, base, frame = frames.pop()
+                        ops, args = code.ops, code.args
+                        engine.leave_function(frame)
+                        del stack[base:]
+                        stack.append(value)
+                    elif op == BLOCK:
+                        attr, block = arg
+                        stack.append(getattr(engine, attr)(block))
+                    elif op == CONST:
+                        stack.append(arg)
+                    else:
+                        raise SystemError(f"bad opcode {op}")
+            except (Done, Next) as signal:
+                # find the innermost loop around the instruction that raised,
+                # unwinding function frames the way the exception would have
+                while (loop := _find_loop(code, pc - 1)) is None:
+                    if not frames:
+                        raise
+                    code, pc, base, frame = frames.pop()
+                    ops, args = code.ops, code.args
+                    engine.leave_function(frame)
+                if isinstance(signal, Next):
+                    del stack[base + loop.next_depth:]
+                    pc = loop.next_target
+                else:
+                    del stack[base + loop.done_depth:]
+                    pc = loop.done_target
+            except Return as r:
+                if not frames:
+                    if function:
+                        return r.args[0]
+                    raise
+                code, pc, base, frame = frames.pop()
+                ops, args = code.ops, code.args
+                engine.leave_function(frame)
+                del stack[base:]
+                stack.append(r.args[0])
+    finally:
+        while frames:
+            engine.leave_function(frames.pop()[3])
+
+
+class VMEngine(Engine):
+    bytecode_cache_size = 1024
+
+    def __init__(self):
+        super().__init__()
+        self.bytecode_cache = LRUCache(self.bytecode_cache_size)
+
+    def fork(self, scope=None):
+        engine = super().fork(scope)
+        engine.bytecode_cache = self.bytecode_cache
+        return engine
+
+    def assemble(self, code):
+        # keyed on identity (programs are not mutated while they run); the
+        # source is kept alongside so the id cannot be reused under us
+        entry = self.bytecode_cache.get(id(code))
+        if entry is None or entry[0] is not code:
+            entry = self.bytecode_cache.put(id(code), (code, assemble(self, code)))
+        return entry[1]
+
+    def eval(self, code):
+        match code:
+            case str() | list() | tuple() | dict():
+                return execute(self, self.assemble(code))
+            case Compiled():
+                value = code.run(self)
+                if self.pending is not None:
+                    signal, self.pending = self.pending, None
+                    raise signal
+                return value
+            case _:
+                return code
+
+    # the VM turns done/next/return into jumps itself and never leaves a
+    # signal pending
+    _eval = eval
+
+    def eval_uncompiled(self, code):
+        # the tree-walking _eval, since this engine's own would assemble
+        # the code again
+        value = BareEngine._eval(self, code)
+        if self.pending is not None:
+            signal, self.pending = self.pending, None
+            raise signal
+        return value
+
+    def call_user_function(self, name, args):
+        func = self.resolve_function(name)
+        frame = self.enter_function(func, args)
+        try:
+            return execute(self, self.assemble(func['body']), function=True)
+        finally:
+            self.leave_function(frame)